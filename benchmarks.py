@@ -0,0 +1,231 @@
+"""
+Benchmarks of the acquisition, conversion, export and render paths. None of
+them need hardware, the serial link is simulated.
+
+    python benchmarks.py --out results.json
+    python benchmarks.py --out new.json --compare results.json
+
+Each benchmark reports the median and fastest time per call; the end to end
+ones report frames per second. --compare exits non-zero if anything got
+slower than the baseline by more than --threshold.
+"""
+
+import json
+import os
+import platform
+import queue
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+
+from tdr_plots.tdr01_control.common import Trace, TraceSettings, RampModel  # noqa: E402
+from tdr_plots.tdr01_control.control import take_trace  # noqa: E402
+from tdr_plots.storage import save_csv  # noqa: E402
+from tdr_plots.emitter import EmitterThread, Frame  # noqa: E402
+from tdr_plots.simulator import SimulatedDevice  # noqa: E402
+from tdr_plots.live_plot import Scope  # noqa: E402
+
+BENCHMARKS = {}
+MIN_TIME = 0.2  # s of repeats per benchmark
+MAX_REPEATS = 50
+
+
+def benchmark(name, unit="s"):
+    def register(func):
+        BENCHMARKS[name] = (func, unit)
+        return func
+
+    return register
+
+
+def time_call(func, min_time=MIN_TIME, max_repeats=MAX_REPEATS, warmup=True):
+    """
+    Median and min time of func(), repeated for at least min_time (a single
+    call if that alone takes min_time).
+    """
+    if warmup:
+        func()
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_repeats:
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time and (len(times) >= 3 or times[0] >= min_time):
+            break
+    return {"value": statistics.median(times), "min": min(times), "repeats": len(times)}
+
+
+def settings_for(npoints):
+    return TraceSettings(npoints=npoints, ramp_model=RampModel(a=60075, rc=16510))
+
+
+def make_take_trace(npoints):
+    def run():
+        device = SimulatedDevice(seed=0)
+        device.setup()
+        device.write(f"POINTS {npoints}\n")
+        # Replay the same recorded reply bytes every call
+        reply = device.dev.reply("TRACE")
+        device.dev.reply = lambda command: reply
+        return time_call(lambda: take_trace(device, npoints=npoints))
+
+    return run
+
+
+def make_trace_conversion(npoints):
+    def run():
+        settings = settings_for(npoints)
+        rxdac = list(np.linspace(1000, 55000, npoints).astype(int))
+        data = list(np.random.default_rng(0).integers(0, 8192, npoints))
+
+        def convert():
+            trace = Trace(settings=settings, rxdac=rxdac, trace=data)
+            return trace.t_nominal, trace.trace_volts
+
+        return time_call(convert)
+
+    return run
+
+
+def make_save_csv(npoints, ntraces):
+    def run():
+        rng = np.random.default_rng(0)
+        rxdac = np.arange(npoints)
+        ramp_time = np.arange(npoints) * 10.0
+        traces = [rng.random(npoints) for _ in range(ntraces)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "bench.csv")
+            return time_call(
+                lambda: save_csv(fname, rxdac, ramp_time, traces), warmup=False
+            )
+
+    return run
+
+
+def make_scope_update(npoints, draw):
+    def run():
+        settings = settings_for(npoints)
+        data_queue = queue.Queue()
+        fig, ax = plt.subplots()
+        scope = Scope(ax, dt=settings.spacing, settings=settings, data_queue=data_queue)
+        rng = np.random.default_rng(0)
+        frames = [Frame(data=rng.integers(0, 8192, npoints)) for _ in range(4)]
+        count = [0]
+
+        def update():
+            data_queue.put(frames[count[0] % len(frames)])
+            scope.update(count[0])
+            count[0] += 1
+            if draw:
+                fig.canvas.draw()
+
+        result = time_call(update)
+        plt.close(fig)
+        return result
+
+    return run
+
+
+def make_end_to_end(npoints, baudrate, nframes):
+    def run():
+        settings = settings_for(npoints)
+        device = SimulatedDevice(baudrate=baudrate, seed=0)
+        device.setup()
+        device.write(f"POINTS {npoints}\n")
+        data_queue = queue.Queue()
+        emitter = EmitterThread(device=device, data_queue=data_queue, settings=settings)
+        emitter.start()
+        try:
+            data_queue.get(timeout=60)  # first frame includes the thread start up
+            t0 = time.perf_counter()
+            for _ in range(nframes):
+                data_queue.get(timeout=60)
+            elapsed = time.perf_counter() - t0
+        finally:
+            emitter.stop()
+        return {"value": nframes / elapsed, "min": None, "repeats": nframes}
+
+    return run
+
+
+for _npoints in (2500, 25000):
+    benchmark(f"take_trace/{_npoints}")(make_take_trace(_npoints))
+    benchmark(f"trace_conversion/{_npoints}")(make_trace_conversion(_npoints))
+    benchmark(f"scope_update/{_npoints}")(make_scope_update(_npoints, draw=False))
+    benchmark(f"scope_update_draw/{_npoints}")(make_scope_update(_npoints, draw=True))
+for _npoints in (2500, 25000, 100000):
+    for _ntraces in (1, 10, 50):
+        benchmark(f"save_csv/{_npoints}x{_ntraces}")(make_save_csv(_npoints, _ntraces))
+benchmark("end_to_end/2500/unthrottled", unit="fps")(make_end_to_end(2500, None, 50))
+benchmark("end_to_end/2500/115200", unit="fps")(make_end_to_end(2500, 115200, 3))
+
+
+def compare(results, baseline, threshold):
+    """Regressions larger than threshold (fractional) relative to the baseline."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None or not old["value"]:
+            continue
+        # The fastest run is less noisy than the median for short benchmarks
+        key = "min" if result.get("min") and old.get("min") else "value"
+        ratio = result[key] / old[key]
+        if result["unit"] == "fps":
+            ratio = 1 / ratio
+        marker = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            marker = "  REGRESSION"
+        click.echo(f"{name:40s} {ratio:6.2f}x baseline{marker}")
+    return regressions
+
+
+@click.command()
+@click.option("--out", "out_fname", default=None, help="Write the results as JSON")
+@click.option("--compare", "baseline_fname", default=None, help="Baseline JSON to compare with")
+@click.option("--threshold", type=float, default=0.2, help="Allowed slow down, 0.2 = 20%")
+@click.option("--filter", "name_filter", default="", help="Only run benchmarks containing this")
+def main(out_fname, baseline_fname, threshold, name_filter):
+    results = {}
+    for name, (func, unit) in BENCHMARKS.items():
+        if name_filter not in name:
+            continue
+        result = func()
+        result["unit"] = unit
+        results[name] = result
+        click.echo(f"{name:40s} {result['value']:12.6g} {unit}")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "matplotlib": matplotlib.__version__,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    if out_fname:
+        with open(out_fname, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline_fname:
+        with open(baseline_fname) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
+import multiprocessing
 from tdr_plots import cli
 import matplotlib
 matplotlib.use('TkAgg')
 
-cli.main()
+if __name__ == "__main__":
+    # Needed by the frozen binary for the --process acquisition process
+    multiprocessing.freeze_support()
+    cli.main()
@@ -1,3 +1,11 @@
-from . import live_plot
+import importlib
 
-__all__ = (live_plot,)
+__all__ = ("live_plot",)
+
+
+def __getattr__(name):
+    # live_plot pulls in matplotlib and Tk, only import it when it's used so
+    # the headless tools (serve, check, ...) don't need a display
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
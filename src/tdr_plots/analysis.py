@@ -0,0 +1,206 @@
+"""
+analysis.py: Reflection coefficient, impedance and fault location.
+
+Everything works on (ntraces, npoints) arrays so a whole archive of
+traces taken with the same settings is processed in one pass; a single
+trace is treated as a batch of one.
+
+For a step of amplitude A launched from a baseline V0 the line voltage is
+V(t) = V0 + A * (1 + rho(t)), so rho = (V - V0) / A - 1 and the impedance
+is Z = Z0 * (1 + rho) / (1 - rho). A and V0 are measured per trace either
+side of the launch edge.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from scipy.ndimage import maximum_filter1d, uniform_filter1d
+
+from .tdr01_control.common import TraceBatch
+
+SPEED_OF_LIGHT = 299792458.0 * 1e-12  # m/ps
+
+
+@dataclass
+class LineModel:
+    z0: float = 50.0
+    velocity_factor: float = 0.66
+
+    @property
+    def velocity(self) -> float:
+        """m/ps"""
+        return SPEED_OF_LIGHT * self.velocity_factor
+
+    def distance(self, t):
+        """One way distance (m) for a round trip time t (ps)."""
+        return np.asarray(t) * self.velocity / 2
+
+
+@dataclass
+class ImpedanceProfile:
+    t: np.ndarray  # (npoints,) ps
+    distance: np.ndarray  # (ntraces, npoints) m from each trace's launch edge
+    rho: np.ndarray  # (ntraces, npoints)
+    impedance: np.ndarray  # (ntraces, npoints) ohms
+    launch: np.ndarray  # (ntraces,) index of the launch edge
+    baseline: np.ndarray  # (ntraces,) V0
+    amplitude: np.ndarray  # (ntraces,) A
+
+
+@dataclass
+class Edges:
+    """Steps in rho found by detect_edges, one entry per step."""
+
+    trace: np.ndarray  # index of the trace in the batch
+    index: np.ndarray  # sample index of the step
+    step: np.ndarray  # change in rho across the step
+    distance: np.ndarray  # m from the launch edge
+
+    def __len__(self):
+        return len(self.index)
+
+
+def _as_2d(volts) -> np.ndarray:
+    return np.atleast_2d(np.asarray(volts, dtype=float))
+
+
+def step_response(y: np.ndarray, width: int) -> np.ndarray:
+    """
+    Change across a `width` sample window of the smoothed traces. An ideal
+    step at sample e peaks at e - step_offset(width).
+    """
+    smoothed = uniform_filter1d(y, size=width, axis=-1, mode="nearest")
+    step = np.zeros_like(smoothed)
+    step[:, :-width] = smoothed[:, width:] - smoothed[:, :-width]
+    return step
+
+
+def step_offset(width: int) -> int:
+    return (width + 1) // 2
+
+
+def find_launch(volts: np.ndarray, width: int = 5) -> np.ndarray:
+    """
+    Index of the launch edge: the peak of the first rise of at least half the
+    largest rise, so an open end (which rises as far again) isn't mistaken
+    for it.
+    """
+    step = step_response(volts, width)
+    peak = step.max(axis=-1, keepdims=True)
+    first = np.argmax(step >= peak / 2, axis=-1)[:, None]
+    index = np.arange(step.shape[-1])[None, :]
+    window = (index >= first) & (index < first + 2 * width)
+    return np.argmax(np.where(window, step, -np.inf), axis=-1) + step_offset(width)
+
+
+def _window_mean(y: np.ndarray, start: np.ndarray, stop: np.ndarray) -> np.ndarray:
+    """Mean of y[i, start[i]:stop[i]] for every row, through the cumulative sum."""
+    npoints = y.shape[-1]
+    start = np.clip(start, 0, npoints - 1)
+    stop = np.clip(stop, start + 1, npoints)
+    cumsum = np.zeros((y.shape[0], npoints + 1))
+    np.cumsum(y, axis=-1, out=cumsum[:, 1:])
+    rows = np.arange(y.shape[0])
+    return (cumsum[rows, stop] - cumsum[rows, start]) / (stop - start)
+
+
+def reflection_coefficient(
+    volts, width: int = 5, incident_width: int = 10, launch: Optional[np.ndarray] = None
+):
+    """
+    rho for every point of every trace along with the launch index, baseline
+    and step amplitude used to normalise it.
+    """
+    volts = _as_2d(volts)
+    if launch is None:
+        launch = find_launch(volts, width)
+    launch = np.broadcast_to(np.asarray(launch), volts.shape[:1])
+    baseline = _window_mean(volts, np.zeros_like(launch), launch - width)
+    start = launch + width
+    amplitude = _window_mean(volts, start, start + incident_width) - baseline
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rho = (volts - baseline[:, None]) / amplitude[:, None] - 1
+    return rho, launch, baseline, amplitude
+
+
+def impedance(rho, z0: float = 50.0) -> np.ndarray:
+    """Line impedance, open and short ends are clipped to large/small values."""
+    rho = np.clip(rho, -0.999, 0.999)
+    return z0 * (1 + rho) / (1 - rho)
+
+
+def impedance_profile(
+    volts, t, line: LineModel = LineModel(), width: int = 5, incident_width: int = 10
+) -> ImpedanceProfile:
+    t = np.asarray(t, dtype=float)
+    rho, launch, baseline, amplitude = reflection_coefficient(
+        volts, width=width, incident_width=incident_width
+    )
+    distance = line.distance(t[None, :] - t[launch][:, None])
+    return ImpedanceProfile(
+        t=t,
+        distance=distance,
+        rho=rho,
+        impedance=impedance(rho, line.z0),
+        launch=launch,
+        baseline=baseline,
+        amplitude=amplitude,
+    )
+
+
+def detect_edges(
+    profile: ImpedanceProfile,
+    threshold: float = 0.05,
+    width: int = 5,
+    separation: int = 20,
+) -> Edges:
+    """
+    Steps in rho of at least `threshold` after the launch edge. A step is kept
+    where it is the largest within `separation` samples, so a slow edge
+    yields one detection rather than one per sample.
+    """
+    rho = np.nan_to_num(profile.rho)
+    step = step_response(rho, width)
+    magnitude = np.abs(step)
+    npoints = rho.shape[-1]
+    after_launch = np.arange(npoints)[None, :] > (profile.launch + 2 * width)[:, None]
+    peaks = (
+        after_launch
+        & (magnitude >= threshold)
+        & (magnitude == maximum_filter1d(magnitude, size=separation, axis=-1))
+    )
+    trace, index = np.nonzero(peaks)
+    centre = np.minimum(index + step_offset(width), npoints - 1)
+    return Edges(
+        trace=trace,
+        index=centre,
+        step=step[trace, index],
+        distance=profile.distance[trace, centre],
+    )
+
+
+def fault_distance(edges: Edges, ntraces: int) -> np.ndarray:
+    """Distance (m) of the largest step of each trace, nan where there is none."""
+    distance = np.full(ntraces, np.nan)
+    if len(edges) == 0:
+        return distance
+    # Sort by trace then size, the largest step of each trace is the last of its run
+    order = np.lexsort((np.abs(edges.step), edges.trace))
+    trace = edges.trace[order]
+    last = np.flatnonzero(np.diff(np.append(trace, -1)) != 0)
+    distance[trace[last]] = edges.distance[order][last]
+    return distance
+
+
+def analyze_batch(
+    batch: TraceBatch,
+    line: LineModel = LineModel(),
+    threshold: float = 0.05,
+    width: int = 5,
+    separation: int = 20,
+):
+    """Impedance profile, edges and main fault distance of every trace in a batch."""
+    profile = impedance_profile(batch.volts, batch.t_nominal, line=line, width=width)
+    edges = detect_edges(profile, threshold=threshold, width=width, separation=separation)
+    return profile, edges, fault_distance(edges, len(batch))
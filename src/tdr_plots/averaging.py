@@ -0,0 +1,89 @@
+"""
+averaging.py: Closed loop choice of the averaging needed for a noise floor.
+
+The noise of a frame summed over n conversions falls as 1/sqrt(n), so one
+estimate of the single conversion noise is enough to work out how many
+conversions a target needs. The instrument sums AVG conversions per
+transfer, and the transfer dominates the frame time on a serial link, so
+as much as possible is averaged in the instrument (up to max_avg) and
+only the rest by accumulating transfers on the host.
+
+The noise is estimated from the difference of successive frames (median
+based, so a change in part of the trace doesn't count as noise) or, with
+a region given, from the spread inside a flat stretch of a single frame.
+"""
+
+from dataclasses import dataclass, field
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .tdr01_control.common import Adc, robust_std
+
+
+def frame_noise(volts, previous=None, region: Optional[Tuple[int, int]] = None) -> float:
+    """
+    RMS noise (V) of a frame, from the flat region if given, otherwise from
+    the difference to the previous frame (assumed to have the same noise).
+    """
+    volts = np.asarray(volts, dtype=float)
+    if region is not None:
+        start, stop = region
+        return float(np.std(volts[start:stop], ddof=1))
+    if previous is None:
+        raise ValueError("Need a previous frame or a flat region to estimate noise")
+    return float(robust_std(volts - previous) / np.sqrt(2))
+
+
+@dataclass
+class AdaptiveAveraging:
+    target: float  # V rms noise wanted in each emitted frame
+    max_avg: int = 256  # largest AVG sent to the instrument
+    max_accumulate: int = 64  # most transfers summed on the host
+    region: Optional[Tuple[int, int]] = None  # flat stretch of samples, if any
+    smoothing: float = 0.3  # weight of the newest estimate
+    sigma1: Optional[float] = None  # noise of a single conversion, V
+    adc: Adc = field(default_factory=Adc)
+    _previous: Optional[Tuple[np.ndarray, int]] = field(default=None, init=False, repr=False)
+
+    def update(self, counts, naverages: int) -> Optional[float]:
+        """Feed one transfer (summed over naverages), returns its noise (V)."""
+        volts = self.adc.to_volts(np.asarray(counts, dtype=float)) / naverages
+        previous = self._previous
+        self._previous = (volts, naverages)
+        if self.region is not None:
+            noise = frame_noise(volts, region=self.region)
+            sigma1 = noise * math.sqrt(naverages)
+        elif previous is not None:
+            # var(a - b) = sigma1**2 * (1/n_a + 1/n_b)
+            old, old_naverages = previous
+            spread = float(robust_std(volts - old))
+            sigma1 = spread / math.sqrt(1 / naverages + 1 / old_naverages)
+            noise = sigma1 / math.sqrt(naverages)
+        else:
+            return None
+        if self.sigma1 is None:
+            self.sigma1 = sigma1
+        else:
+            self.sigma1 += self.smoothing * (sigma1 - self.sigma1)
+        return noise
+
+    def plan(self, naverages: int) -> Tuple[int, int]:
+        """
+        (AVG, number of transfers to sum) for the next frame. Until there is
+        a noise estimate the current AVG is kept, one transfer at a time.
+        """
+        if self.sigma1 is None:
+            return naverages, 1
+        needed = max(1, math.ceil((self.sigma1 / self.target) ** 2))
+        count = min(math.ceil(needed / self.max_avg), self.max_accumulate)
+        # Spread the conversions evenly over the transfers
+        avg = min(max(1, math.ceil(needed / count)), self.max_avg)
+        return avg, count
+
+    def noise(self, naverages: int) -> Optional[float]:
+        """Expected noise (V) of a frame summed over naverages conversions."""
+        if self.sigma1 is None:
+            return None
+        return self.sigma1 / math.sqrt(naverages)
@@ -0,0 +1,173 @@
+"""
+batch.py: Offline analysis of directories of captures on all cores.
+
+Captures are save_csv files (traces in volts) and broadcast recordings
+(.tdr, raw frames). Each file is loaded and analysed as one batch in a
+worker process; files are handed out in chunks so the per task overhead
+stays small next to the work. Every trace becomes one row of the summary
+table: fault distance and size, number of steps, impedance statistics and,
+with golden traces, the deviation from the closest one.
+"""
+
+import concurrent.futures
+import functools
+import logging
+import os
+import warnings
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import analysis
+from . import broadcast
+from .monitor import ReferenceMonitor
+from .storage import load_csv
+from .tdr01_control.common import Adc, time_axis
+
+log_ = logging.getLogger("monitor_tdr")
+
+EXTENSIONS = (".csv", ".tdr")
+COLUMNS = (
+    "file",
+    "trace",
+    "npoints",
+    "n_edges",
+    "fault_m",
+    "fault_step",
+    "z_median",
+    "rho_min",
+    "rho_max",
+    "golden_rms",
+    "golden_max_abs",
+    "error",
+)
+
+
+def discover(paths: Iterable[str]) -> List[str]:
+    """Capture files under the given files and directories, sorted."""
+    found = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            found.extend(
+                os.path.join(root, fname)
+                for fname in files
+                if fname.lower().endswith(EXTENSIONS)
+            )
+    return sorted(found)
+
+
+def load_capture(fname) -> Tuple[np.ndarray, np.ndarray]:
+    """Time axis (ps) and (ntraces, npoints) volts of a CSV or a recording."""
+    if fname.lower().endswith(".tdr"):
+        with broadcast.open_recording(fname) as stream:
+            t = time_axis(stream.settings, stream.rxdac)
+            frames = list(stream)
+            naverages = np.array(
+                [frame.naverages or stream.settings.naverages for frame in frames]
+            )
+        if not frames:
+            return t, np.empty((0, len(t)))
+        data = np.stack([frame.data for frame in frames]).astype(float)
+        return t, Adc().to_volts(data) / naverages[:, None]
+    _, t, traces = load_csv(fname)
+    return t, traces
+
+
+def analyze_volts(
+    t,
+    volts,
+    line: analysis.LineModel,
+    threshold: float = 0.05,
+    golden: Optional[ReferenceMonitor] = None,
+) -> dict:
+    """Summary columns (one array entry per trace) of a batch of traces."""
+    ntraces, npoints = volts.shape
+    profile = analysis.impedance_profile(volts, t, line=line)
+    edges = analysis.detect_edges(profile, threshold=threshold)
+    fault = analysis.fault_distance(edges, ntraces)
+
+    fault_step = np.full(ntraces, np.nan)
+    if len(edges):
+        # The step at the fault, i.e. the largest of each trace
+        order = np.lexsort((np.abs(edges.step), edges.trace))
+        fault_step[edges.trace[order]] = edges.step[order]
+
+    after_launch = np.arange(npoints)[None, :] > profile.launch[:, None]
+    impedance = np.where(after_launch & np.isfinite(profile.impedance), profile.impedance, np.nan)
+    rho = np.where(after_launch, profile.rho, np.nan)
+
+    golden_rms = np.full(ntraces, np.nan)
+    golden_max_abs = np.full(ntraces, np.nan)
+    if golden is not None and golden.golden.shape[-1] == npoints:
+        result = golden.check_volts(volts)
+        golden_rms, golden_max_abs = result.rms, result.max_abs
+
+    with warnings.catch_warnings():
+        # All-nan rows (no samples after the launch) give nan, not a warning
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return dict(
+            trace=np.arange(ntraces),
+            npoints=np.full(ntraces, npoints),
+            n_edges=np.bincount(edges.trace, minlength=ntraces),
+            fault_m=fault,
+            fault_step=fault_step,
+            z_median=np.nanmedian(impedance, axis=-1),
+            rho_min=np.nanmin(rho, axis=-1),
+            rho_max=np.nanmax(rho, axis=-1),
+            golden_rms=golden_rms,
+            golden_max_abs=golden_max_abs,
+        )
+
+
+def analyze_file(fname, line, threshold=0.05, golden=None) -> pd.DataFrame:
+    try:
+        t, volts = load_capture(fname)
+        columns = analyze_volts(t, volts, line, threshold=threshold, golden=golden)
+        error = ""
+    except (OSError, ValueError, KeyError) as e:
+        log_.warning(f"Can't analyse {fname}: {e}")
+        columns = dict(trace=[-1])
+        error = str(e)
+    frame = pd.DataFrame(columns)
+    frame.insert(0, "file", fname)
+    frame["error"] = error
+    return frame.reindex(columns=COLUMNS)
+
+
+def _analyze_chunk(fnames, line, threshold, golden) -> pd.DataFrame:
+    return pd.concat(
+        [analyze_file(fname, line, threshold, golden) for fname in fnames],
+        ignore_index=True,
+    )
+
+
+def analyze_files(
+    fnames: List[str],
+    line: analysis.LineModel = analysis.LineModel(),
+    threshold: float = 0.05,
+    golden: Optional[ReferenceMonitor] = None,
+    jobs: Optional[int] = None,
+    chunksize: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Summary table of every trace in fnames, analysed on `jobs` processes
+    (all cores by default, 1 to stay in this process).
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if chunksize is None:
+        # A few chunks per worker balances uneven files without much overhead
+        chunksize = max(1, len(fnames) // (jobs * 4))
+    chunks = [fnames[i : i + chunksize] for i in range(0, len(fnames), chunksize)]
+    work = functools.partial(_analyze_chunk, line=line, threshold=threshold, golden=golden)
+    if jobs == 1 or len(chunks) <= 1:
+        results = [work(chunk) for chunk in chunks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(work, chunks))
+    if not results:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(results, ignore_index=True)
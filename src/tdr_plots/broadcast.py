@@ -0,0 +1,345 @@
+"""
+broadcast.py: Publish the frames of one instrument to local consumers.
+
+Messages are framed as a fixed header (magic, type, payload length)
+followed by the payload:
+
+    SETTINGS   json settings, int32 rxdac table
+    FRAME      uint64 sequence number, float64 timestamp, uint32 number of
+               averages summed (0 for the settings' AVG), float64 change
+               gate score (NaN if not gated), int32 trace
+    SUBSCRIBE  one byte subscription mode
+
+The server sends SETTINGS once on connection and then FRAME messages.
+Subscribers either take the full stream (buffered up to a limit, after
+which a stalled subscriber is dropped) or only the latest frame, skipping
+whatever arrived while they were busy. A recording is the same message
+stream written to a file.
+"""
+
+import logging
+import os
+import socket
+import struct
+import threading
+import queue
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .tdr01_control.common import TraceSettings
+from .emitter import Frame
+
+log_ = logging.getLogger("monitor_tdr")
+
+DEFAULT_ADDRESS = "tcp://127.0.0.1:5025"
+
+MAGIC = b"TDR2"
+MSG_SETTINGS = 1
+MSG_FRAME = 2
+MSG_SUBSCRIBE = 3
+
+MODE_FULL = "full"
+MODE_LATEST = "latest"
+_MODES = {MODE_FULL: b"F", MODE_LATEST: b"L"}
+
+_HEADER = struct.Struct("<4sBI")
+_FRAME_HEADER = struct.Struct("<QdId")
+_SETTINGS_HEADER = struct.Struct("<I")
+_DTYPE = np.dtype("<i4")
+_HANDSHAKE_TIMEOUT = 5
+
+
+def encode_message(msg_type: int, payload: bytes) -> bytes:
+    return _HEADER.pack(MAGIC, msg_type, len(payload)) + payload
+
+
+def encode_settings(settings: TraceSettings, rxdac) -> bytes:
+    text = settings.model_dump_json().encode()
+    rxdac = np.asarray(rxdac if rxdac is not None else [], dtype=_DTYPE)
+    payload = _SETTINGS_HEADER.pack(len(text)) + text + rxdac.tobytes()
+    return encode_message(MSG_SETTINGS, payload)
+
+
+def decode_settings(payload: bytes) -> Tuple[TraceSettings, Optional[np.ndarray]]:
+    (length,) = _SETTINGS_HEADER.unpack_from(payload)
+    start = _SETTINGS_HEADER.size
+    settings = TraceSettings.model_validate_json(payload[start : start + length])
+    rxdac = np.frombuffer(payload[start + length :], dtype=_DTYPE)
+    return settings, (rxdac if len(rxdac) else None)
+
+
+def encode_frame(frame: Frame) -> bytes:
+    data = np.asarray(frame.data, dtype=_DTYPE)
+    score = frame.score if frame.score is not None else float("nan")
+    header = _FRAME_HEADER.pack(frame.seq, frame.timestamp, frame.naverages or 0, score)
+    payload = header + data.tobytes()
+    return encode_message(MSG_FRAME, payload)
+
+
+def decode_frame(payload: bytes) -> Frame:
+    seq, timestamp, naverages, score = _FRAME_HEADER.unpack_from(payload)
+    data = np.frombuffer(payload, dtype=_DTYPE, offset=_FRAME_HEADER.size)
+    return Frame(
+        data=data,
+        seq=seq,
+        timestamp=timestamp,
+        naverages=naverages or None,
+        score=None if np.isnan(score) else score,
+    )
+
+
+def read_message(stream) -> Optional[Tuple[int, bytes]]:
+    """Read one message from a binary file object, None at end of stream."""
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    magic, msg_type, length = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"Bad message header {header!r}")
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return msg_type, payload
+
+
+def parse_address(address: str) -> Tuple[int, object]:
+    """
+    Socket family and address for tcp://host:port, host:port or
+    unix:///path/to/socket
+    """
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://") :]
+    if address.startswith("tcp://"):
+        address = address[len("tcp://") :]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class TraceStream:
+    """Reader for a stream of messages, from a socket or a recording."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        message = read_message(self.stream)
+        if message is None or message[0] != MSG_SETTINGS:
+            raise ValueError("Stream does not start with the trace settings")
+        self.settings, self.rxdac = decode_settings(message[1])
+
+    def read_frame(self) -> Optional[Frame]:
+        while True:
+            message = read_message(self.stream)
+            if message is None:
+                return None
+            msg_type, payload = message
+            if msg_type == MSG_FRAME:
+                return decode_frame(payload)
+            if msg_type == MSG_SETTINGS:
+                self.settings, self.rxdac = decode_settings(payload)
+
+    def __iter__(self) -> Iterator[Frame]:
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TraceClient(TraceStream):
+    """Subscriber to a TraceServer."""
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, mode: str = MODE_LATEST):
+        self.address = address
+        self.mode = mode
+        self.connect()
+
+    def connect(self):
+        family, sockaddr = parse_address(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(sockaddr)
+        self.sock.sendall(encode_message(MSG_SUBSCRIBE, _MODES[self.mode]))
+        super().__init__(self.sock.makefile("rb"))
+
+    def interrupt(self):
+        """End a read_frame blocked in another thread, reconnect() to read again."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    def close(self):
+        super().close()
+        self.sock.close()
+
+
+def open_recording(fname) -> TraceStream:
+    return TraceStream(open(fname, "rb"))
+
+
+class _Subscriber:
+    def __init__(self, conn: socket.socket, mode: str, queue_size: int):
+        self.conn = conn
+        self.mode = mode
+        self.closed = threading.Event()
+        self.pending = queue.Queue(maxsize=1 if mode == MODE_LATEST else queue_size)
+        self.thread = threading.Thread(target=self.send_thread, daemon=True)
+
+    def offer(self, message: bytes) -> None:
+        try:
+            self.pending.put_nowait(message)
+        except queue.Full:
+            if self.mode == MODE_LATEST:
+                # Replace the frame the subscriber hasn't picked up yet
+                try:
+                    self.pending.get_nowait()
+                except queue.Empty:
+                    pass
+                self.pending.put_nowait(message)
+            else:
+                log_.warning("Subscriber fell behind the full stream, dropping it")
+                self.close()
+
+    def send_thread(self):
+        try:
+            while not self.closed.is_set():
+                message = self.pending.get()
+                if message is None:
+                    break
+                self.conn.sendall(message)
+        except OSError as e:
+            log_.info(f"Subscriber disconnected: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            self.pending.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class TraceServer:
+    """Owns the published settings and fans each frame out to the subscribers."""
+
+    def __init__(
+        self,
+        settings: TraceSettings,
+        rxdac: Optional[List[int]],
+        address: str = DEFAULT_ADDRESS,
+        queue_size: int = 256,
+    ):
+        self.settings = settings
+        self.rxdac = rxdac
+        self.address = address
+        self.queue_size = queue_size
+        self.subscribers: List[_Subscriber] = []
+        self.lock = threading.Lock()
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        family, sockaddr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.remove(sockaddr)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(sockaddr)
+        self.sock.listen()
+        if family != socket.AF_UNIX:
+            host, port = self.sock.getsockname()[:2]
+            self.address = f"tcp://{host}:{port}"
+        log_.info(f"Serving traces on {self.address}")
+        self.thread = threading.Thread(target=self.accept_thread, daemon=True)
+        self.thread.start()
+
+    def accept_thread(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            try:
+                self.subscribe(conn)
+            except (OSError, ValueError) as e:
+                log_.warning(f"Rejected subscriber: {e}")
+                conn.close()
+
+    def subscribe(self, conn: socket.socket):
+        conn.settimeout(_HANDSHAKE_TIMEOUT)
+        message = read_message(conn.makefile("rb"))
+        conn.settimeout(None)
+        if message is None or message[0] != MSG_SUBSCRIBE:
+            raise ValueError("Expected a subscription request")
+        modes = {value: key for key, value in _MODES.items()}
+        mode = modes.get(message[1], MODE_LATEST)
+        conn.sendall(encode_settings(self.settings, self.rxdac))
+        subscriber = _Subscriber(conn, mode=mode, queue_size=self.queue_size)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        subscriber.thread.start()
+        log_.info(f"New {mode} subscriber")
+
+    def publish(self, frame: Frame) -> None:
+        message = encode_frame(frame)
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if not s.closed.is_set()]
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.offer(message)
+
+    def close(self):
+        if self.sock is not None:
+            family = self.sock.family
+            self.sock.close()
+            self.sock = None
+            if family == socket.AF_UNIX:
+                path = parse_address(self.address)[1]
+                if os.path.exists(path):
+                    os.remove(path)
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.close()
+            self.subscribers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def record(stream: TraceStream, fname, nframes: Optional[int] = None) -> int:
+    """Write the settings and the frames of a stream to a recording file."""
+    count = 0
+    with open(fname, "wb") as f:
+        f.write(encode_settings(stream.settings, stream.rxdac))
+        for frame in stream:
+            f.write(encode_frame(frame))
+            count += 1
+            if nframes is not None and count >= nframes:
+                break
+    log_.info(f"Recorded {count} frames to {fname}")
+    return count
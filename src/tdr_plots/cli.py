@@ -1,16 +1,34 @@
+import contextlib
+import os
 import time
+import queue
 from typing import Optional
 import logging
 import serial
 import serial.tools.list_ports
 import click
+import numpy as np
 from pydantic import BaseModel
 
 from .tdr01_control.common import TraceSettings, RampModel
 from .tdr01_control.control import Device, take_trace
-from .live_plot import run_monitor_plot
+from .tdr01_control.integrity import FrameCheck
+from .emitter import EmitterThread, queued_frames
+from .averaging import AdaptiveAveraging
+from .gating import ChangeGate
+from .tdr01_control.sweep import RxdacCache, take_sweep, merge_sweep
+from .simulator import SimulatedDevice, SyntheticLine
+from .storage import load_csv, save_csv
+from .library import TraceLibrary, LibraryLockedError, DEFAULT_PATH as DEFAULT_LIBRARY_PATH
+from .library import DEFAULT_CAPACITY as DEFAULT_LIBRARY_CAPACITY
+from . import broadcast
+from . import monitor
+from . import batch
+from .analysis import LineModel
+from .profiling import profiler
 
 BAUDRATE = 115200
+DEFAULT_RXDAC_CACHE = os.path.join(os.path.dirname(DEFAULT_LIBRARY_PATH), "rxdac_cache.json")
 
 
 class Setup(BaseModel):
@@ -91,34 +109,103 @@ def list_serial_ports():
     return sorted([port.device for port in ports if port.description], reverse=True)
 
 
-@click.option("--device", "device_str", default=None)
-@click.option("--maxtime", type=int, default=20000)
-@click.option("--spacing", type=int, default=10)
-@click.option("--ramp_mode", type=int, default=1)
-@click.option("--start_time", type=float, default=0)
-@click.option("--rc", type=float, default=None)
-@click.option("--m", type=float, default=None)
-@click.option("--dummy", is_flag=True)
-@click.option(
-    "--sleep", "sleep_time", type=float, default=2, help="Sleep time in between traces"
+_INSTRUMENT_OPTIONS = (
+    click.option("--device", "device_str", default=None),
+    click.option("--maxtime", type=int, default=20000),
+    click.option("--spacing", type=int, default=10),
+    click.option("--ramp_mode", type=int, default=1),
+    click.option("--start_time", type=float, default=0),
+    click.option("--rc", type=float, default=None),
+    click.option("--m", type=float, default=None),
+    click.option("--dummy", is_flag=True),
+    click.option(
+        "--validate/--no-validate",
+        default=True,
+        help="Check each trace for out of range values and glitches, retaking bad stretches",
+    ),
 )
-@click.command()
-def cli_main(
-    device_str, maxtime, spacing, ramp_mode, start_time, rc, m, dummy, sleep_time
-):
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.INFO)
-    log_.setLevel(logging.DEBUG)
 
-    if device_str is None:
-        com_ports = list_serial_ports()  # Fetch COM ports
-        if len(com_ports) == 0:
-            log_.error(
-                "No com ports found or declared. Use the --device command to set."
-            )
-            raise UserWarning("No com ports found or declared.")
-        device = com_ports[0]
+_ACQUISITION_OPTIONS = (
+    click.option(
+        "--rate",
+        type=float,
+        default=1,
+        help="Frames per second of the --dummy source, 0 for as fast as possible",
+    ),
+    click.option(
+        "--noise-floor",
+        type=float,
+        default=None,
+        help="Adjust AVG (and sum transfers) to reach this RMS noise per frame (V)",
+    ),
+    click.option(
+        "--max-avg",
+        type=int,
+        default=256,
+        help="Largest AVG --noise-floor sends to the instrument",
+    ),
+    click.option(
+        "--process",
+        "use_process",
+        is_flag=True,
+        help="Acquire in a separate process, sharing frames through shared memory",
+    ),
+)
+
+
+def instrument_options(func):
+    """Device and timing options of the commands which own the device."""
+    for option in reversed(_INSTRUMENT_OPTIONS):
+        func = option(func)
+    return func
+
+
+def trace_options(func):
+    """Instrument options plus those of the continuous acquisition loop."""
+    for option in reversed(_INSTRUMENT_OPTIONS + _ACQUISITION_OPTIONS):
+        func = option(func)
+    return func
+
 
+_GATE_OPTIONS = (
+    click.option(
+        "--gate",
+        "gate_threshold",
+        type=float,
+        default=None,
+        help="Pass on only frames changed by more than this many noise sigmas",
+    ),
+    click.option(
+        "--heartbeat",
+        type=float,
+        default=5,
+        help="With --gate, pass a frame at least this often (s)",
+    ),
+)
+
+
+def gate_options(func):
+    """Change gating options of the commands which pass frames on."""
+    for option in reversed(_GATE_OPTIONS):
+        func = option(func)
+    return func
+
+
+def make_gate(gate_threshold, heartbeat, settings: TraceSettings) -> Optional[ChangeGate]:
+    if gate_threshold is None:
+        return None
+    return ChangeGate(
+        threshold=gate_threshold, heartbeat=heartbeat, naverages=settings.naverages
+    )
+
+
+def make_averaging(noise_floor, max_avg) -> Optional[AdaptiveAveraging]:
+    if noise_floor is None:
+        return None
+    return AdaptiveAveraging(target=noise_floor, max_avg=max_avg)
+
+
+def make_settings(maxtime, spacing, ramp_mode, start_time, rc, m) -> TraceSettings:
     ramp_model = RampModel(a=60075)
     if rc:
         ramp_model.rc = rc
@@ -129,28 +216,626 @@ def cli_main(
 
     settings = TraceSettings(
         spacing=spacing,
-        ramp_mode=ramp_mode,
+        ramp=ramp_mode,  # ramp_mode is only accepted under its aliases
         ramp_model=ramp_model,
         i_start=int(round(start_time / spacing)),
         npoints=npoints,
     )
+    assert settings.npoints == npoints
+    return settings
+
+
+def load_reference(fname) -> np.ndarray:
+    """First trace of a CSV as a deconvolution reference, checked for a step."""
+    reference = load_csv(fname)[2][0]
+    finite = reference[np.isfinite(reference)]
+    if len(finite) < 2 or np.ptp(finite) == 0:
+        raise click.BadParameter(
+            f"{fname} has no step to deconvolve against", param_hint="--reference"
+        )
+    return reference
+
+
+def select_stored(library: TraceLibrary, names) -> None:
+    """Select just the named library entries."""
+    try:
+        entries = [library.find(name) for name in names]
+    except KeyError as e:
+        raise click.BadParameter(
+            f"No stored trace named {e.args[0]!r} in {library.path}", param_hint="--show"
+        )
+    library.clear_selection()
+    for entry in entries:
+        library.select(entry)
+
 
+def check_reference(reference, settings: TraceSettings) -> None:
+    if reference is not None and len(reference) != settings.npoints:
+        raise click.BadParameter(
+            f"The reference has {len(reference)} points, the traces {settings.npoints}",
+            param_hint="--reference",
+        )
+
+
+def parse_ramps(ctx, param, value):
+    """--ramp MODE:SPACING:MAXTIME[:RC] values as (mode, spacing, maxtime, rc)."""
+    ramps = []
+    for spec in value:
+        fields = spec.split(":")
+        try:
+            if len(fields) not in (3, 4):
+                raise ValueError
+            mode, spacing, maxtime = int(fields[0]), int(fields[1]), int(fields[2])
+            rc = float(fields[3]) if len(fields) == 4 else None
+        except ValueError:
+            raise click.BadParameter(f"{spec} is not MODE:SPACING:MAXTIME[:RC]")
+        ramps.append((mode, spacing, maxtime, rc))
+    return ramps
+
+
+@contextlib.contextmanager
+def open_instrument(device_str, settings: TraceSettings, dummy=False, set_timing=False):
+    """Yield the configured device and its RXDAC table, (None, None) for --dummy"""
     if dummy:
-        run_monitor_plot(settings=settings, rxdac=None, device=None)
+        yield None, None
         return
 
-    assert settings.npoints == npoints
+    if device_str is None:
+        com_ports = list_serial_ports()  # Fetch COM ports
+        if len(com_ports) == 0:
+            log_.error(
+                "No com ports found or declared. Use the --device command to set."
+            )
+            raise UserWarning("No com ports found or declared.")
+        device_str = com_ports[0]
+
     resource = f"ASRL{device_str}::INSTR"
     with Device(baudrate=BAUDRATE, resource=resource) as device:
         header = setup(
             device=device,
             settings=settings,
-            set_timing=((rc is not None) or (m is not None)),
+            set_timing=set_timing,
         )
         log_.info(f"header: {header}")
         rxdac = take_trace(device=device, command="RXDAC?",
                            npoints=settings.npoints)
-        run_monitor_plot(settings=settings, rxdac=rxdac, device=device)
+        yield device, rxdac
+
+
+@trace_options
+@gate_options
+@click.option(
+    "--server",
+    "server_address",
+    default=None,
+    help="Attach to a running `monitor_tdr serve` instead of a serial port",
+)
+@click.option(
+    "--reference",
+    "reference_fname",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="CSV saved from the plot whose first trace is the step to deconvolve against",
+)
+@click.option(
+    "--library",
+    "library_path",
+    type=click.Path(file_okay=False),
+    default=DEFAULT_LIBRARY_PATH,
+    show_default=True,
+    help="Directory of the stored trace library, kept between sessions",
+)
+@click.option(
+    "--library-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help=f"Stored traces kept before the least recently used is replaced (a new library "
+    f"holds {DEFAULT_LIBRARY_CAPACITY}, an existing one is resized)",
+)
+@click.option(
+    "--show",
+    "show_names",
+    multiple=True,
+    help="Stored trace to draw from the start, replacing the last selection (repeatable)",
+)
+@click.option("--profile", is_flag=True, help="Time each stage of the live pipeline")
+@click.option(
+    "--profile-out",
+    "profile_fname",
+    default="monitor_tdr_profile.json",
+    help="Where --profile writes its summary on exit",
+)
+@click.option(
+    "--cprofile",
+    is_flag=True,
+    help="With --profile also cProfile the acquisition and GUI threads",
+)
+@click.option(
+    "--sleep", "sleep_time", type=float, default=2, help="Sleep time in between traces"
+)
+@click.group(invoke_without_command=True)
+@click.pass_context
+def cli_main(
+    ctx,
+    device_str,
+    maxtime,
+    spacing,
+    ramp_mode,
+    start_time,
+    rc,
+    m,
+    dummy,
+    rate,
+    noise_floor,
+    max_avg,
+    validate,
+    use_process,
+    gate_threshold,
+    heartbeat,
+    server_address,
+    reference_fname,
+    library_path,
+    library_size,
+    show_names,
+    profile,
+    profile_fname,
+    cprofile,
+    sleep_time,
+):
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    log_.setLevel(logging.DEBUG)
+
+    if ctx.invoked_subcommand is not None:
+        return
+
+    from .live_plot import run_monitor_plot  # pylint: disable=import-outside-toplevel
+
+    if profile:
+        profiler.enable(cprofile=cprofile)
+
+    reference = None
+    if reference_fname is not None:
+        reference = load_reference(reference_fname)
+    try:
+        library = TraceLibrary(library_path, capacity=library_size)
+    except LibraryLockedError as e:
+        raise click.ClickException(f"{e}, give it another --library")
+    if show_names:
+        select_stored(library, show_names)
+
+    if server_address is not None:
+        with broadcast.TraceClient(server_address, mode=broadcast.MODE_LATEST) as client:
+            check_reference(reference, client.settings)
+            run_monitor_plot(
+                settings=client.settings,
+                rxdac=client.rxdac,
+                device=None,
+                source=client,
+                reference=reference,
+                gate=make_gate(gate_threshold, heartbeat, client.settings),
+                library=library,
+                profile_fname=profile_fname,
+            )
+        return
+
+    settings = make_settings(maxtime, spacing, ramp_mode, start_time, rc, m)
+    check_reference(reference, settings)
+    with open_instrument(
+        device_str,
+        settings,
+        dummy=dummy,
+        set_timing=((rc is not None) or (m is not None)),
+    ) as (device, rxdac):
+        run_monitor_plot(
+            settings=settings,
+            rxdac=rxdac,
+            device=device,
+            use_process=use_process,
+            rate=rate,
+            averaging=make_averaging(noise_floor, max_avg),
+            check=FrameCheck() if validate else None,
+            gate=make_gate(gate_threshold, heartbeat, settings),
+            reference=reference,
+            library=library,
+            profile_fname=profile_fname,
+        )
+
+
+@cli_main.command()
+@trace_options
+@gate_options
+@click.option(
+    "--listen",
+    "address",
+    default=broadcast.DEFAULT_ADDRESS,
+    help="tcp://host:port or unix:///path/to/socket",
+)
+def serve(
+    device_str,
+    maxtime,
+    spacing,
+    ramp_mode,
+    start_time,
+    rc,
+    m,
+    dummy,
+    rate,
+    noise_floor,
+    max_avg,
+    validate,
+    use_process,
+    gate_threshold,
+    heartbeat,
+    address,
+):
+    """Own the device and publish every trace to local subscribers."""
+    settings = make_settings(maxtime, spacing, ramp_mode, start_time, rc, m)
+    with open_instrument(
+        device_str,
+        settings,
+        dummy=dummy,
+        set_timing=((rc is not None) or (m is not None)),
+    ) as (device, rxdac):
+        data_queue = queue.Queue()
+        emitter_thread = EmitterThread(
+            device=device,
+            data_queue=data_queue,
+            settings=settings,
+            use_process=use_process,
+            rate=rate,
+            averaging=make_averaging(noise_floor, max_avg),
+            check=FrameCheck() if validate else None,
+            gate=make_gate(gate_threshold, heartbeat, settings),
+        )
+        with broadcast.TraceServer(settings, rxdac, address=address) as server:
+            emitter_thread.start()
+            try:
+                for frame in queued_frames(data_queue, emitter_thread.is_alive):
+                    server.publish(frame)
+            except KeyboardInterrupt:
+                log_.info("Stopping server")
+                return
+            finally:
+                emitter_thread.stop()
+        raise click.ClickException("The acquisition stopped")
+
+
+@cli_main.command()
+@click.argument("fname")
+@click.option("--server", "server_address", default=broadcast.DEFAULT_ADDRESS)
+@click.option("--nframes", type=int, default=None, help="Stop after this many frames")
+def record(fname, server_address, nframes):
+    """Record the full trace stream of a running server to FNAME."""
+    with broadcast.TraceClient(server_address, mode=broadcast.MODE_FULL) as client:
+        try:
+            broadcast.record(client, fname, nframes=nframes)
+        except KeyboardInterrupt:
+            log_.info("Recording stopped")
+
+
+@cli_main.command()
+@trace_options
+@click.option(
+    "--golden",
+    "golden_fname",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="CSV saved from the plot, every trace in it is an accepted reference",
+)
+@click.option("--max-abs", type=float, default=None, help="Limit on max |dV| (V)")
+@click.option("--rms", type=float, default=None, help="Limit on the RMS deviation (V)")
+@click.option(
+    "--window",
+    type=(float, float),
+    default=None,
+    help="Only compare between these times (ps)",
+)
+@click.option("--count", type=int, default=1, help="Frames to check, 0 to run until stopped")
+@click.option("--server", "server_address", default=None)
+def check(
+    device_str,
+    maxtime,
+    spacing,
+    ramp_mode,
+    start_time,
+    rc,
+    m,
+    dummy,
+    rate,
+    noise_floor,
+    max_avg,
+    validate,
+    use_process,
+    golden_fname,
+    max_abs,
+    rms,
+    window,
+    count,
+    server_address,
+):
+    """Check frames against golden traces, exiting non-zero on a failure."""
+    _, t, golden = load_csv(golden_fname)
+    limits = monitor.Limits(max_abs=max_abs, rms=rms, window=window)
+    data_queue = queue.Queue()
+    nframes = count or None
+
+    def make_monitor(settings):
+        if golden.shape[-1] != settings.npoints:
+            raise click.BadParameter(
+                f"The golden traces have {golden.shape[-1]} points, "
+                f"the frames {settings.npoints}",
+                param_hint="--golden",
+            )
+        return monitor.ReferenceMonitor(
+            golden=golden,
+            t=t,
+            limits=limits,
+            naverages=settings.naverages,
+            on_fail=[monitor.log_failure],
+        )
+
+    if server_address is not None:
+        with broadcast.TraceClient(server_address, mode=broadcast.MODE_FULL) as client:
+            reference_monitor = make_monitor(client.settings)
+            emitter_thread = EmitterThread(
+                device=None, data_queue=data_queue, settings=client.settings, source=client
+            )
+            emitter_thread.start()
+            try:
+                checked, failed = monitor.run_checks(
+                    reference_monitor, data_queue, nframes, alive=emitter_thread.is_alive
+                )
+            finally:
+                emitter_thread.stop()
+    else:
+        settings = make_settings(maxtime, spacing, ramp_mode, start_time, rc, m)
+        reference_monitor = make_monitor(settings)
+        with open_instrument(
+            device_str,
+            settings,
+            dummy=dummy,
+            set_timing=((rc is not None) or (m is not None)),
+        ) as (device, _):
+            emitter_thread = EmitterThread(
+                device=device,
+                data_queue=data_queue,
+                settings=settings,
+                use_process=use_process,
+                rate=rate,
+                averaging=make_averaging(noise_floor, max_avg),
+                check=FrameCheck() if validate else None,
+            )
+            emitter_thread.start()
+            try:
+                checked, failed = monitor.run_checks(
+                    reference_monitor, data_queue, nframes, alive=emitter_thread.is_alive
+                )
+            finally:
+                emitter_thread.stop()
+
+    click.echo(f"{checked - failed}/{checked} frames passed")
+    if failed or not checked or (nframes is not None and checked < nframes):
+        ctx = click.get_current_context()
+        ctx.exit(1)
+
+
+@cli_main.command()
+@instrument_options
+@click.argument("fname", type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    "--ramp",
+    "ramps",
+    multiple=True,
+    default=("2:100:200000",),
+    callback=parse_ramps,
+    show_default=True,
+    help="Further ramp as MODE:SPACING:MAXTIME[:RC], after the --ramp_mode one",
+)
+@click.option("--ntraces", type=int, default=1, help="Traces with each ramp")
+@click.option(
+    "--rxdac-cache",
+    "rxdac_cache_fname",
+    type=click.Path(dir_okay=False),
+    default=DEFAULT_RXDAC_CACHE,
+    show_default=True,
+    help="File keeping each ramp's RXDAC? table between runs",
+)
+@click.option(
+    "--blend",
+    type=click.FloatRange(0, 1),
+    default=0.2,
+    help="Fraction of each overlap the ramps are crossfaded over",
+)
+def sweep(
+    device_str,
+    maxtime,
+    spacing,
+    ramp_mode,
+    start_time,
+    rc,
+    m,
+    dummy,
+    validate,
+    fname,
+    ramps,
+    ntraces,
+    rxdac_cache_fname,
+    blend,
+):
+    """Take traces with several ramps and save them merged onto one axis."""
+    primary = make_settings(maxtime, spacing, ramp_mode, start_time, rc, m)
+    settings_list = [primary] + [
+        make_settings(ramp_maxtime, ramp_spacing, mode, start_time, ramp_rc, m)
+        for mode, ramp_spacing, ramp_maxtime, ramp_rc in ramps
+    ]
+    with contextlib.ExitStack() as stack:
+        if dummy:
+            device = stack.enter_context(SimulatedDevice(line=SyntheticLine()))
+            rxdac = None
+        else:
+            device, rxdac = stack.enter_context(
+                open_instrument(
+                    device_str, primary, set_timing=((rc is not None) or (m is not None))
+                )
+            )
+        cache = RxdacCache(rxdac_cache_fname, instrument=device.query("*IDN?").strip())
+        if rxdac is not None:
+            cache.put(primary, rxdac)
+        parts = take_sweep(
+            device,
+            settings_list,
+            cache=cache,
+            check=FrameCheck() if validate else None,
+            ntraces=ntraces,
+        )
+    merged = merge_sweep(parts, blend=blend)
+    save_csv(fname, rxdac=merged.rxdac, ramp_time=merged.t, traces=merged.volts)
+    for k, settings in enumerate(settings_list):
+        log_.info(
+            f"Ramp {settings.ramp_mode}: {np.count_nonzero(merged.part == k)} points "
+            f"at {settings.spacing} ps"
+        )
+
+
+@cli_main.command()
+@gate_options
+@click.option("--server", "server_address", default=broadcast.DEFAULT_ADDRESS)
+@click.option(
+    "--recording",
+    "recording_fname",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Render a recording, one frame per interval, instead of the live stream",
+)
+@click.option("--interval", type=float, default=1.0, help="Seconds between snapshots")
+@click.option("--http", "http_address", default=None, help="host:port to serve snapshots on")
+@click.option(
+    "--out-dir",
+    type=click.Path(file_okay=False, writable=True),
+    default=None,
+    help="Directory to write latest.png/latest.svg to",
+)
+@click.option(
+    "--format", "formats", type=click.Choice(("png", "svg")), multiple=True, default=("png",)
+)
+@click.option("--sequence", is_flag=True, help="With --out-dir also keep every snapshot")
+@click.option("--size", type=(float, float), default=(12, 6), help="Width and height (in)")
+@click.option("--dpi", type=int, default=100)
+@click.option(
+    "--history",
+    "history_mode",
+    type=click.Choice(("off", "waterfall", "persistence")),
+    default="off",
+)
+def snapshot(
+    gate_threshold,
+    heartbeat,
+    server_address,
+    recording_fname,
+    interval,
+    http_address,
+    out_dir,
+    formats,
+    sequence,
+    size,
+    dpi,
+    history_mode,
+):
+    """Render PNG/SVG snapshots without a display, over HTTP or to a directory."""
+    # pylint: disable=import-outside-toplevel
+    from .snapshot import SnapshotRenderer, SnapshotServer, latest_frames, run_snapshots
+
+    if http_address is None and out_dir is None:
+        raise click.UsageError("Give --http and/or --out-dir")
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+
+    with contextlib.ExitStack() as stack:
+        if recording_fname is not None:
+            stream = stack.enter_context(broadcast.open_recording(recording_fname))
+            frames = iter(stream)
+        else:
+            stream = stack.enter_context(
+                broadcast.TraceClient(server_address, mode=broadcast.MODE_LATEST)
+            )
+            data_queue = queue.Queue()
+            emitter_thread = EmitterThread(
+                device=None,
+                data_queue=data_queue,
+                settings=stream.settings,
+                source=stream,
+                gate=make_gate(gate_threshold, heartbeat, stream.settings),
+            )
+            emitter_thread.start()
+            stack.callback(emitter_thread.stop)
+            frames = latest_frames(data_queue, emitter_thread.is_alive)
+
+        renderer = SnapshotRenderer(
+            stream.settings, stream.rxdac, size=size, dpi=dpi, history_mode=history_mode
+        )
+        if http_address is not None:
+            host, _, port = http_address.rpartition(":")
+            stack.enter_context(
+                SnapshotServer(
+                    renderer, (host or "127.0.0.1", int(port)), fmt=formats[0], interval=interval
+                )
+            )
+        try:
+            rendered = run_snapshots(
+                renderer, frames, interval, out_dir, formats=formats, sequence=sequence
+            )
+            log_.info(f"Rendered {rendered} frames")
+            if recording_fname is None:
+                raise click.ClickException("The trace source stopped")
+            if http_address is not None:
+                log_.info("End of the recording, still serving the last frame")
+                while True:
+                    # Short sleeps rather than one wait, which Ctrl-C can't end on Windows
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            log_.info("Stopping snapshots")
+
+
+@cli_main.command()
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    "--out", "out_fname", default="analysis_summary.csv", help="Summary table (CSV)"
+)
+@click.option(
+    "--golden",
+    "golden_fname",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="CSV of golden traces to report the deviation from",
+)
+@click.option("--z0", type=float, default=50.0, help="Reference impedance (ohms)")
+@click.option("--velocity-factor", type=float, default=0.66)
+@click.option("--threshold", type=float, default=0.05, help="Smallest step in rho to report")
+@click.option("--jobs", type=int, default=None, help="Worker processes, default all cores")
+@click.option("--chunksize", type=int, default=None, help="Files per task")
+def analyze(paths, out_fname, golden_fname, z0, velocity_factor, threshold, jobs, chunksize):
+    """Analyse every capture (.csv, .tdr) under PATHS into one summary table."""
+    fnames = batch.discover(paths)
+    golden = None
+    if golden_fname is not None:
+        _, t, traces = load_csv(golden_fname)
+        golden = monitor.ReferenceMonitor(golden=traces, t=t)
+    log_.info(f"Analysing {len(fnames)} files")
+    summary = batch.analyze_files(
+        fnames,
+        line=LineModel(z0=z0, velocity_factor=velocity_factor),
+        threshold=threshold,
+        golden=golden,
+        jobs=jobs,
+        chunksize=chunksize,
+    )
+    summary.to_csv(out_fname, index=False)
+    failed = summary.loc[summary["error"].fillna("") != "", "file"].nunique()
+    click.echo(
+        f"{int((summary['trace'] >= 0).sum())} traces from {len(fnames)} files "
+        f"({failed} unreadable), summary written to {out_fname}"
+    )
 
 
 def main():
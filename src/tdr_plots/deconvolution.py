@@ -0,0 +1,117 @@
+"""
+deconvolution.py: Sharpen traces by deconvolving the measured launch step.
+
+A trace is the line's step response convolved with the instrument's edge.
+Dividing the spectrum of the trace's derivative by that of a reference
+step (Tikhonov regularised so noise outside the edge's bandwidth isn't
+amplified) and integrating back gives the response to a faster edge,
+optionally shaped to a Gaussian of a given rise time.
+
+Traces are resampled onto a uniform grid first since the ramp time axis
+isn't evenly spaced. The resampling weights, FFT length and taper depend
+only on the time axis and point count and are computed once, so the per
+frame cost is a few vectorized operations and two real FFTs per trace.
+"""
+
+import functools
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import fft
+from scipy.signal import windows
+
+# 10-90% rise time of a Gaussian step is 2*sqrt(2)*erfinv(0.8) sigma
+GAUSSIAN_RISE = 2.5631
+
+
+@functools.lru_cache(maxsize=32)
+def fft_plan(npoints: int, taper: float = 0.05) -> Tuple[int, np.ndarray]:
+    """
+    Padded FFT length (no wrap around) and window for npoints samples. The
+    window only tapers the far end of the record, the launch edge is at the
+    start.
+    """
+    nfft = fft.next_fast_len(2 * npoints, real=True)
+    window = np.ones(npoints)
+    ntaper = int(npoints * taper)
+    if ntaper > 1:
+        window[npoints - ntaper :] = windows.hann(2 * ntaper)[ntaper:]
+    return nfft, window
+
+
+class UniformResampler:
+    """Linear interpolation from a fixed, increasing axis onto a uniform grid."""
+
+    def __init__(self, t, npoints: Optional[int] = None):
+        t = np.asarray(t, dtype=float)
+        npoints = npoints or len(t)
+        self.t = np.linspace(t[0], t[-1], npoints)
+        self.dt = self.t[1] - self.t[0]
+        right = np.clip(np.searchsorted(t, self.t, side="right"), 1, len(t) - 1)
+        self.left = right - 1
+        self.right = right
+        self.weight = (self.t - t[self.left]) / (t[self.right] - t[self.left])
+
+    def __call__(self, y) -> np.ndarray:
+        y = np.atleast_2d(np.asarray(y, dtype=float))
+        return y[:, self.left] * (1 - self.weight) + y[:, self.right] * self.weight
+
+
+class Deconvolver:
+    def __init__(
+        self,
+        reference,
+        t,
+        regularization: float = 1e-3,
+        rise_time: Optional[float] = None,
+    ):
+        """
+        reference: measured step of the instrument on the axis t (ps)
+        regularization: noise floor relative to the peak of |R|^2
+        rise_time: 10-90% rise time (ps) of the edge to shape the output to
+        """
+        if len(reference) != len(t):
+            raise ValueError(
+                f"Reference has {len(reference)} points, the traces have {len(t)}"
+            )
+        self.resample = UniformResampler(t)
+        npoints = len(self.resample.t)
+        self.nfft, self.taper = fft_plan(npoints)
+
+        impulse = np.diff(self.resample(reference)[0], prepend=np.nan)
+        impulse[0] = 0
+        step = impulse.sum()
+        if not np.isfinite(step) or step == 0:
+            raise ValueError("Reference has no step to deconvolve against")
+        impulse /= step
+        spectrum = fft.rfft(impulse * self.taper, self.nfft)
+        power = np.abs(spectrum) ** 2
+        inverse = np.conj(spectrum) / (power + regularization * power.max())
+        # Delay the result by the reference edge's position so the output
+        # stays on the same time axis rather than starting at the launch
+        freq = fft.rfftfreq(self.nfft, d=self.resample.dt)
+        delay = np.argmax(impulse) * self.resample.dt
+        inverse *= np.exp(-2j * np.pi * freq * delay)
+        if rise_time:
+            sigma = rise_time / GAUSSIAN_RISE
+            inverse *= np.exp(-2 * (np.pi * freq * sigma) ** 2)
+        self.inverse = inverse
+
+    @property
+    def t(self) -> np.ndarray:
+        return self.resample.t
+
+    def __call__(self, traces) -> np.ndarray:
+        """Deconvolved (ntraces, npoints) traces on the uniform axis self.t"""
+        y = self.resample(traces)
+        npoints = y.shape[-1]
+        derivative = np.diff(y, axis=-1, prepend=y[:, :1]) * self.taper
+        spectrum = fft.rfft(derivative, self.nfft, axis=-1)
+        response = fft.irfft(spectrum * self.inverse, self.nfft, axis=-1)
+        return np.cumsum(response[:, :npoints], axis=-1) + y[:, :1]
+
+
+def deconvolve(traces, t, reference, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+    """Offline helper: uniform time axis and deconvolved traces."""
+    deconvolver = Deconvolver(reference, t, **kwargs)
+    return deconvolver.t, deconvolver(traces)
@@ -0,0 +1,413 @@
+"""
+emitter.py: Trace acquisition loop feeding the plot through a queue.
+
+Acquisition runs either in a thread of the plotting process or, with
+use_process=True, in a child process which hands frames back through a
+shared memory ring and sends only the sequence numbers over a pipe.
+"""
+
+from dataclasses import dataclass, field
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from .tdr01_control.common import TraceSettings
+from .tdr01_control.control import Device
+from .tdr01_control import control
+from .tdr01_control.integrity import CorruptFrameError, FrameCheck, take_valid_trace
+from .shared_ring import SharedFrameRing
+from .simulator import SyntheticLine
+from .averaging import AdaptiveAveraging
+from .gating import ChangeGate
+from .profiling import profiler
+
+log_ = logging.getLogger("monitor_tdr")
+
+_POLL_TIME = 0.1
+_REPORT_TIME = 0.5  # between profile reports of an acquisition process
+_REPORT_WAIT = 5  # for the last report after stopping the process
+
+
+@dataclass
+class Frame:
+    """One acquired trace in raw ADC counts (summed over the averages)."""
+
+    data: np.ndarray
+    seq: int = 0
+    timestamp: float = field(default_factory=time.time)
+    naverages: Optional[int] = None  # None: the settings' naverages
+    score: Optional[float] = None  # change since the last frame passed, set by a ChangeGate
+
+
+@dataclass
+class _ProfileReport:
+    """Spans of an acquisition process and, from its end, its cProfile stats."""
+
+    spans: list
+    stats: Optional[dict] = None
+
+
+def merge_report(report: _ProfileReport) -> None:
+    """Add the spans and stats of an acquisition process to this one's profiler."""
+    for name, seconds in report.spans:
+        profiler.record(name, seconds)
+    if report.stats is not None:
+        profiler.stats["emitter"] = report.stats
+
+
+def queued_frames(data_queue, alive: Callable[[], bool]) -> Iterator[Frame]:
+    """
+    Frames from an emitter's queue until alive() says it stopped and the
+    queue is empty. Waits in short polls, so Ctrl-C also gets through on
+    Windows.
+    """
+    while True:
+        try:
+            yield data_queue.get(timeout=_POLL_TIME)
+        except queue.Empty:
+            if not alive():
+                return
+
+
+class EmitterThread:
+    def __init__(self, device: Device, data_queue, settings: TraceSettings, **kwargs):
+        self.device: Device = device
+        if device is not None:
+            # Time the write/wait/parse steps of each transfer with --profile
+            device.span = profiler.span
+        self.data_queue = data_queue
+        self.settings = settings
+        self.sleep_time = kwargs.get("sleep_time", 0)
+        self.use_process = kwargs.get("use_process", False)
+        self.nslots = kwargs.get("nslots", 16)
+        # Anything with read_frame(), e.g. a broadcast.TraceClient, instead of a device
+        self.source = kwargs.get("source", None)
+        # Without a device frames come from a simulated line at this rate (0: unpaced)
+        self.rate = kwargs.get("rate", 1)
+        self.line = kwargs.get("line", None) or SyntheticLine()
+        self.rng = np.random.default_rng(kwargs.get("seed", None))
+        self.next_time = None
+        # Closed loop AVG for a noise floor, summing transfers on the host if needed
+        self.averaging: Optional[AdaptiveAveraging] = kwargs.get("averaging", None)
+        self.naverages = settings.naverages  # AVG of the last transfer
+        # AVG the instrument is known to hold, None to write it before the next transfer
+        self.device_naverages: Optional[int] = settings.naverages
+        # Range/glitch checks with partial retakes of device frames if set
+        self.check: Optional[FrameCheck] = kwargs.get("check", None)
+        # Passes on only changed frames (and heartbeats) if set
+        self.gate: Optional[ChangeGate] = kwargs.get("gate", None)
+        self.thread = None
+        self.process = None
+        self.stop_event = threading.Event()
+        # The source was interrupted by stop() and has to reconnect on start()
+        self.interrupted = False
+        self.seq = 0
+
+    def put(self, frame: Frame) -> None:
+        if self.gate is not None and not self.gate.offer(frame):
+            return
+        self.data_queue.put(frame)
+
+    def emit(self, trace, naverages: Optional[int] = None) -> None:
+        self.put(
+            Frame(
+                data=np.asarray(trace),
+                seq=self.seq,
+                naverages=naverages or self.settings.naverages,
+            )
+        )
+        self.seq += 1
+
+    def trace_thread(self):
+        with profiler.thread_profile("emitter"):
+            self.acquire()
+
+    def acquire(self):
+        if self.source is not None:
+            self.source_thread()
+            return
+
+        while not self.stop_event.is_set():
+            try:
+                if self.averaging is not None:
+                    self.averaged_thread()
+                elif self.device is None:
+                    self.dummy_thread()
+                else:
+                    self.emit(self.take_frame(self.naverages))
+                    time.sleep(self.sleep_time)
+            except CorruptFrameError as e:
+                log_.warning(f"Dropped frame: {e}")
+
+    def pace(self):
+        """Wait for the next simulated frame at self.rate frames per second."""
+        if not self.rate:
+            return
+        now = time.perf_counter()
+        if self.next_time is None or self.next_time < now - 1:
+            # Don't burst to catch up after a stall
+            self.next_time = now
+        self.stop_event.wait(max(self.next_time - now, 0))
+        self.next_time += 1 / self.rate
+
+    def take_frame(self, naverages: int):
+        """One transfer summed over naverages, from the device or the simulation."""
+        if self.device is None:
+            self.pace()
+            return self.line.counts(
+                self.settings.npoints,
+                naverages,
+                self.rng,
+                spacing=self.settings.spacing,
+                i_start=self.settings.i_start,
+            )
+        if naverages != self.device_naverages:
+            self.device.write(f"AVG {naverages}\n")
+            self.device_naverages = naverages
+        if self.check is not None:
+            trace = take_valid_trace(self.device, self.settings, self.check, naverages)
+        else:
+            trace = control.take_trace(self.device, npoints=self.settings.npoints)
+        log_.debug(trace)
+        return trace
+
+    def dummy_thread(self):
+        """Emit one simulated trace, paced to self.rate frames per second."""
+        self.emit(self.take_frame(self.settings.naverages))
+
+    def averaged_thread(self):
+        """Emit one frame with the noise floor asked of self.averaging."""
+        naverages, count = self.averaging.plan(self.naverages)
+        if naverages != self.naverages or count > 1:
+            log_.debug("AVG %d, summing %d transfers", naverages, count)
+        total = np.zeros(self.settings.npoints, dtype=np.int64)
+        for _ in range(count):
+            if self.stop_event.is_set():
+                return
+            trace = np.asarray(self.take_frame(naverages), dtype=np.int64)
+            self.naverages = naverages
+            self.averaging.update(trace, naverages)
+            total += trace
+        self.emit(total.astype(np.int32), naverages=naverages * count)
+        if self.device is not None:
+            time.sleep(self.sleep_time)
+
+    def source_thread(self):
+        """Forward frames from another process' stream until it ends."""
+        while not self.stop_event.is_set():
+            try:
+                frame = self.source.read_frame()
+            except (OSError, ValueError) as e:
+                log_.info(f"Trace source failed: {e}")
+                break
+            if frame is None:
+                log_.info("Trace source closed")
+                break
+            self.put(frame)
+
+    def relay_thread(self, ring: SharedFrameRing, conn, process_stop):
+        """Move frames announced by the acquisition process onto the queue."""
+        while not self.stop_event.is_set():
+            if not conn.poll(_POLL_TIME):
+                continue
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if isinstance(message, _ProfileReport):
+                merge_report(message)
+                continue
+            seq, timestamp, naverages = message
+            data = ring.read(seq)
+            if data is None:
+                log_.warning("Frame %d overwritten before it was read", seq)
+                continue
+            self.put(Frame(data=data, seq=seq, timestamp=timestamp, naverages=naverages))
+            self.seq = seq + 1
+        process_stop.set()
+        # Frames still in the pipe are dropped, but the last report is wanted
+        while profiler.enabled and conn.poll(_REPORT_WAIT):
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if isinstance(message, _ProfileReport):
+                merge_report(message)
+        conn.close()
+        ring.close()
+
+    def is_alive(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            log_.info("Stop thread")
+            self.stop_event.set()
+            if hasattr(self.source, "interrupt"):
+                # read_frame may be blocked on a stalled or gated stream
+                self.source.interrupt()
+                self.interrupted = True
+            if self.thread:
+                self.thread.join()
+            if self.process is not None:
+                self.process.join()
+                self.process = None
+            self.stop_event.clear()
+            log_.info("Thread stopped")
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            if self.use_process and self.source is None:
+                self.start_process()
+                return
+            if self.interrupted:
+                try:
+                    self.source.reconnect()
+                except OSError as e:
+                    log_.error(f"Can't reconnect to the trace source: {e}")
+                    return
+                self.interrupted = False
+            log_.info("Start thread")
+
+            self.thread = threading.Thread(target=self.trace_thread)
+            self.thread.daemon = (
+                True  # Ensure thread closes when the main program exits
+            )
+            self.thread.start()
+
+    def start_process(self):
+        log_.info("Start acquisition process")
+        # The serial port can only be held by one process
+        resource = None
+        baudrate = None
+        if self.device is not None:
+            resource = self.device.resource
+            baudrate = self.device.baudrate
+            self.device.close()
+
+        ctx = multiprocessing.get_context("spawn")
+        ring = SharedFrameRing(npoints=self.settings.npoints, nslots=self.nslots)
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        process_stop = ctx.Event()
+        self.process = ctx.Process(
+            target=acquisition_process,
+            kwargs=dict(
+                resource=resource,
+                baudrate=baudrate,
+                settings=self.settings,
+                ring_name=ring.name,
+                nslots=self.nslots,
+                conn=send_conn,
+                stop_event=process_stop,
+                sleep_time=self.sleep_time,
+                rate=self.rate,
+                line=self.line,
+                averaging=self.averaging,
+                check=self.check,
+                start_seq=self.seq,
+                profile=(profiler.enabled, profiler.cprofile),
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        send_conn.close()
+
+        self.thread = threading.Thread(
+            target=self.relay_thread, args=(ring, recv_conn, process_stop), daemon=True
+        )
+        self.thread.start()
+
+    def start_dummy(self, *args):
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        log_.info("Start thread")
+
+        self.thread = threading.Thread(target=self.dummy_thread)
+        self.thread.daemon = True  # Ensure thread closes when the main program exits
+        self.thread.start()
+
+
+class _RingEmitter(EmitterThread):
+    """Emitter used inside the acquisition process, publishing to the ring."""
+
+    def __init__(self, ring: SharedFrameRing, conn, **kwargs):
+        super().__init__(data_queue=None, **kwargs)
+        self.ring = ring
+        self.conn = conn
+        self.next_report = time.monotonic()
+
+    def emit(self, trace, naverages: Optional[int] = None) -> None:
+        self.ring.write(self.seq, trace)
+        self.conn.send((self.seq, time.time(), naverages or self.settings.naverages))
+        self.seq += 1
+        if profiler.enabled and time.monotonic() >= self.next_report:
+            self.conn.send(_ProfileReport(spans=profiler.take_outbox()))
+            self.next_report = time.monotonic() + _REPORT_TIME
+
+
+def acquisition_process(
+    resource: Optional[str],
+    baudrate: Optional[int],
+    settings: TraceSettings,
+    ring_name: str,
+    nslots: int,
+    conn,
+    stop_event,
+    sleep_time: float = 0,
+    rate: float = 1,
+    line: Optional[SyntheticLine] = None,
+    averaging: Optional[AdaptiveAveraging] = None,
+    check: Optional[FrameCheck] = None,
+    start_seq: int = 0,
+    profile: Tuple[bool, bool] = (False, False),
+):
+    """
+    Entry point of the acquisition process, runs until stop_event is set.
+    profile: the plotting process' profiler enabled and cprofile flags, the
+        spans (and cProfile stats at the end) are sent back with the frames
+    """
+    ring = SharedFrameRing(npoints=settings.npoints, nslots=nslots, name=ring_name)
+    if profile[0]:
+        profiler.enable(cprofile=profile[1])
+        profiler.outbox = []
+    device = None
+    try:
+        if resource is not None:
+            device = Device(resource=resource, baudrate=baudrate)
+            device.setup()
+        emitter = _RingEmitter(
+            ring=ring,
+            conn=conn,
+            device=device,
+            settings=settings,
+            sleep_time=sleep_time,
+            rate=rate,
+            line=line,
+            averaging=averaging,
+            check=check,
+        )
+        emitter.seq = start_seq
+        # A previous acquisition process may have left another AVG set
+        emitter.device_naverages = None
+        emitter.stop_event = stop_event
+        emitter.trace_thread()
+        if profiler.enabled:
+            conn.send(
+                _ProfileReport(
+                    spans=profiler.take_outbox(), stats=profiler.profile_stats("emitter")
+                )
+            )
+    except (BrokenPipeError, EOFError):
+        pass
+    finally:
+        if device is not None:
+            device.close()
+        conn.close()
+        ring.close()
+
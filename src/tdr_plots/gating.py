@@ -0,0 +1,104 @@
+"""
+gating.py: Pass on only the frames which differ from the last one shown.
+
+On a stable cable nearly every frame equals the previous one within the
+noise, yet each would be converted, drawn and recorded. ChangeGate
+compares a frame with the last frame it let through, averaged with the
+frames dropped since (up to depth of them, so its own noise doesn't
+repeat in every comparison while slow drift still shows). The
+difference is averaged over a sliding window so single sample noise
+can't trigger it, and the largest windowed deviation is scored in units
+of its expected noise. Frames scoring above the threshold pass, as does one
+heartbeat frame every heartbeat seconds so consumers know the source is
+alive. Every frame offered is tagged with its score.
+
+The noise per conversion is estimated from successive frames as in
+averaging.py, so the threshold follows AVG changes and the cable.
+"""
+
+from dataclasses import dataclass, field
+import math
+import time
+from typing import Optional
+
+import numpy as np
+
+from .tdr01_control.common import Adc, robust_std
+
+
+def window_mean(x, window: int) -> np.ndarray:
+    """Means of every complete window (padding the ends would add noise)."""
+    cumsum = np.concatenate(([0.0], np.cumsum(x)))
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+@dataclass
+class ChangeGate:
+    threshold: float = 6.0  # score (noise sigmas) at which a frame passes
+    window: int = 16  # samples averaged before comparing
+    heartbeat: Optional[float] = 5.0  # s between frames passed regardless
+    depth: int = 16  # frames averaged into the reference
+    naverages: int = 2  # for frames which don't say
+    smoothing: float = 0.1  # weight of the newest noise estimate
+    sigma1: Optional[float] = None  # noise of a single conversion, V
+    adc: Adc = field(default_factory=Adc)
+    passed: int = 0
+    dropped: int = 0
+    _reference: Optional[tuple] = field(default=None, init=False, repr=False)
+    _previous: Optional[tuple] = field(default=None, init=False, repr=False)
+    _last_time: float = field(default=0.0, init=False, repr=False)
+
+    def volts(self, frame) -> np.ndarray:
+        naverages = frame.naverages or self.naverages
+        return self.adc.to_volts(np.asarray(frame.data, dtype=float)) / naverages
+
+    def update_noise(self, volts, naverages: int) -> None:
+        previous = self._previous
+        self._previous = (volts, naverages)
+        if previous is None or len(previous[0]) != len(volts):
+            return
+        old, old_naverages = previous
+        sigma1 = float(robust_std(volts - old)) / math.sqrt(1 / naverages + 1 / old_naverages)
+        if self.sigma1 is None:
+            self.sigma1 = sigma1
+        else:
+            self.sigma1 += self.smoothing * (sigma1 - self.sigma1)
+
+    def accumulate(self, volts, naverages: int) -> None:
+        """Average an unchanged frame into the reference."""
+        reference, reference_naverages = self._reference
+        total = min(reference_naverages + naverages, self.depth * naverages)
+        reference = reference + (volts - reference) * (naverages / total)
+        self._reference = (reference, total)
+
+    def score(self, volts, naverages: int) -> float:
+        """Largest windowed deviation from the reference in noise sigmas."""
+        reference, reference_naverages = self._reference
+        if self.sigma1 is None or len(reference) != len(volts):
+            return math.inf
+        window = min(self.window, len(volts))
+        deviation = window_mean(volts - reference, window)
+        sigma = self.sigma1 * math.sqrt((1 / naverages + 1 / reference_naverages) / window)
+        if sigma == 0:
+            return math.inf if np.any(deviation) else 0.0
+        return float(np.max(np.abs(deviation)) / sigma)
+
+    def offer(self, frame, now: Optional[float] = None) -> bool:
+        """Tag frame with its score, True if it should be passed on."""
+        now = time.monotonic() if now is None else now
+        naverages = frame.naverages or self.naverages
+        volts = self.volts(frame)
+        self.update_noise(volts, naverages)
+        if self._reference is None:
+            frame.score = math.inf
+        else:
+            frame.score = self.score(volts, naverages)
+        heartbeat = self.heartbeat is not None and now - self._last_time >= self.heartbeat
+        if frame.score < self.threshold and not heartbeat:
+            self.dropped += 1
+            self.accumulate(volts, naverages)
+            return False
+        self._reference = (volts, naverages)
+        self._last_time = now
+        self.passed += 1
+        return True
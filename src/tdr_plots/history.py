@@ -0,0 +1,68 @@
+"""
+history.py: Fixed memory history of the most recent frames.
+
+FrameHistory is a preallocated (depth, npoints) ring; appending writes one
+row. PersistenceMap keeps a (nbins, npoints) histogram of the frames in the
+ring, adding the new frame's bins and removing those of the frame it
+replaced, so each update touches 2 * npoints cells whatever the depth.
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class FrameHistory:
+    def __init__(self, depth: int, npoints: int):
+        self.depth = depth
+        self.npoints = npoints
+        self.frames = np.full((depth, npoints), np.nan)
+        self.head = 0  # next row to write
+        self.count = 0
+
+    def append(self, y) -> Tuple[int, Optional[np.ndarray]]:
+        """Write a frame, returning its row and the frame it replaced if any."""
+        row = self.head
+        evicted = self.frames[row].copy() if self.count == self.depth else None
+        self.frames[row] = y
+        self.head = (row + 1) % self.depth
+        self.count = min(self.count + 1, self.depth)
+        return row, evicted
+
+    def ordered(self) -> np.ndarray:
+        """Stored frames, oldest first."""
+        if self.count < self.depth:
+            return self.frames[: self.count]
+        return np.roll(self.frames, -self.head, axis=0)
+
+
+class PersistenceMap:
+    def __init__(self, npoints: int, ylim: Tuple[float, float], nbins: int = 256):
+        self.npoints = npoints
+        self.ylim = ylim
+        self.nbins = nbins
+        self.counts = np.zeros((nbins, npoints), dtype=np.int32)
+        self.columns = np.arange(npoints)
+
+    def bins(self, y) -> np.ndarray:
+        lo, hi = self.ylim
+        index = (np.asarray(y, dtype=float) - lo) * (self.nbins / (hi - lo))
+        index = np.nan_to_num(index, nan=-1)
+        return np.clip(index, 0, self.nbins - 1).astype(np.intp)
+
+    def add(self, y, weight: int = 1) -> np.ndarray:
+        """Add (or with weight=-1 remove) a frame, returns the bins it touched."""
+        bins = self.bins(y)
+        # Each column gets exactly one bin so the fancy index has no repeats
+        self.counts[bins, self.columns] += weight
+        return bins
+
+    def fill(self, frames) -> None:
+        """Rebuild from a stack of frames (e.g. FrameHistory.ordered())."""
+        self.counts[:] = 0
+        frames = np.atleast_2d(frames)
+        frames = frames[~np.all(np.isnan(frames), axis=-1)]
+        if len(frames):
+            flat = (self.bins(frames) * self.npoints + self.columns).ravel()
+            counts = np.bincount(flat, minlength=self.counts.size)
+            self.counts[:] = counts.reshape(self.counts.shape)
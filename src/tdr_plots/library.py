@@ -0,0 +1,332 @@
+"""
+library.py: Bounded library of stored traces that persists across sessions.
+
+Stored traces live in one preallocated (capacity, max_points) float32
+array, a memory mapped .npy file when the library has a directory, with
+the name, time, length and trace settings of each entry in index.json
+beside it. Storing writes one row and the index, so it costs the same
+however full the library is; once it is full the least recently used
+entry is replaced. Only the selected entries are drawn (storing a trace
+selects it and deselects the oldest past max_selected), each reduced to
+the min and max of every bucket of samples so a stored trace costs the
+same to redraw whatever its length. Saving reads the full resolution
+rows back from the array. A trace longer than the rows widens the array,
+copying it once, and a new capacity resizes it the same way. A lock file
+keeps a second session from writing to the same directory.
+"""
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .tdr01_control.common import TraceSettings
+
+log_ = logging.getLogger("monitor_tdr")
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".tdr_plots", "library")
+DEFAULT_CAPACITY = 256
+DEFAULT_MAX_POINTS = 16384
+DEFAULT_MAX_SELECTED = 16  # stored traces drawn at once
+RENDER_BUCKETS = 1000  # min/max pairs drawn per stored trace, about a screen width
+INDEX_FNAME = "index.json"
+TRACES_FNAME = "traces.npy"
+LOCK_FNAME = "lock"
+
+
+@dataclass
+class LibraryEntry:
+    slot: int  # row of the trace array
+    number: int  # counts up over the life of the library
+    name: str
+    npoints: int
+    created: str
+    used: int  # library clock at the last use, for LRU eviction
+    selected: bool = True
+    settings: Optional[dict] = None
+
+
+class LibraryLockedError(OSError):
+    pass
+
+
+def new_traces(shape: Tuple[int, int], fname: Optional[str] = None) -> np.ndarray:
+    """An all NaN float32 trace array, memory mapped to a new .npy file if fname."""
+    if fname is None:
+        return np.full(shape, np.nan, dtype=np.float32)
+    traces = np.lib.format.open_memmap(fname, mode="w+", dtype=np.float32, shape=shape)
+    traces[:] = np.nan
+    return traces
+
+
+def lock_directory(path: str):
+    """
+    Hold the lock file of a library directory, raising LibraryLockedError if
+    another process (or TraceLibrary) has it. The OS drops the lock with the
+    process, so a crash doesn't leave the library locked.
+    """
+    lock_file = open(os.path.join(path, LOCK_FNAME), "a+")
+    try:
+        if os.name == "nt":
+            import msvcrt  # pylint: disable=import-outside-toplevel,import-error
+
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl  # pylint: disable=import-outside-toplevel,import-error
+
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        lock_file.close()
+        raise LibraryLockedError(f"The trace library {path} is open in another session") from e
+    return lock_file
+
+
+def unlock_directory(lock_file) -> None:
+    if os.name == "nt":
+        import msvcrt  # pylint: disable=import-outside-toplevel,import-error
+
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    lock_file.close()
+
+
+def minmax_decimate(x, y, nbuckets: int = RENDER_BUCKETS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The min and max of y in each of nbuckets buckets, in their original
+    order, so peaks and steps survive at a fraction of the points.
+    """
+    y = np.asarray(y)
+    npoints = len(y)
+    if npoints <= 2 * nbuckets:
+        return np.asarray(x), y
+    size = -(-npoints // nbuckets)
+    nrows = -(-npoints // size)
+    padded = np.full(nrows * size, np.nan)
+    padded[:npoints] = y
+    rows = padded.reshape(nrows, size)
+    # nan never wins, all nan buckets fall back to their first sample
+    low = np.argmin(np.where(np.isnan(rows), np.inf, rows), axis=1)
+    high = np.argmax(np.where(np.isnan(rows), -np.inf, rows), axis=1)
+    index = np.sort(np.stack((low, high), axis=1), axis=1) + (np.arange(nrows) * size)[:, None]
+    index = np.minimum(index.ravel(), npoints - 1)
+    return np.asarray(x)[index], y[index]
+
+
+class TraceLibrary:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        capacity: Optional[int] = None,
+        max_points: int = DEFAULT_MAX_POINTS,
+        max_selected: int = DEFAULT_MAX_SELECTED,
+    ):
+        """
+        path: directory holding the library, None to keep it in memory only.
+            Only one TraceLibrary at a time can open a directory.
+        capacity: entries kept, DEFAULT_CAPACITY for a new library; an
+            existing one keeps its own unless a different capacity is given
+        max_points: width of a new library, it widens for longer traces
+        """
+        self.path = path
+        self.max_selected = max_selected
+        self.entries: Dict[int, LibraryEntry] = {}
+        self.clock = 0
+        self.next_number = 0
+        self.lock_file = None
+        if path is None:
+            self.traces = new_traces((capacity or DEFAULT_CAPACITY, max_points))
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.lock_file = lock_directory(path)
+            fname = os.path.join(path, TRACES_FNAME)
+            if os.path.exists(fname):
+                self.traces = np.load(fname, mmap_mode="r+")
+                self.load_index()
+            else:
+                self.traces = new_traces((capacity or DEFAULT_CAPACITY, max_points), fname)
+        self.capacity, self.max_points = self.traces.shape
+        if capacity is not None:
+            self.resize(capacity)
+
+    def reallocate(self, capacity: int, max_points: int, moves: Dict[int, int]) -> None:
+        """Copy the rows (old slot: new slot) to a new (capacity, max_points) array."""
+        width = min(self.max_points, max_points)
+        shape = (capacity, max_points)
+        if self.path is None:
+            traces = new_traces(shape)
+            for old, new in moves.items():
+                traces[new, :width] = self.traces[old, :width]
+            self.traces = traces
+        else:
+            fname = os.path.join(self.path, TRACES_FNAME)
+            tmp_fname = f"{fname}.tmp"
+            traces = new_traces(shape, tmp_fname)
+            for old, new in moves.items():
+                traces[new, :width] = self.traces[old, :width]
+            traces.flush()
+            # Release both maps before replacing the file
+            del traces
+            self.traces = None
+            os.replace(tmp_fname, fname)
+            self.traces = np.load(fname, mmap_mode="r+")
+        self.capacity, self.max_points = shape
+
+    def reserve(self, npoints: int) -> None:
+        """Widen the rows to hold traces of npoints, copying the library."""
+        if npoints <= self.max_points:
+            return
+        log_.info(f"Widening the library from {self.max_points} to {npoints} points")
+        self.reallocate(self.capacity, npoints, {slot: slot for slot in self.entries})
+
+    def resize(self, capacity: int) -> None:
+        """Hold capacity entries, dropping the least recently used ones past it."""
+        if capacity == self.capacity:
+            return
+        if capacity < 1:
+            raise ValueError(f"Library capacity {capacity}, it has to hold a trace")
+        log_.info(f"Resizing the library from {self.capacity} to {capacity} traces")
+        kept = sorted(self.entries.values(), key=lambda entry: entry.used)[-capacity:]
+        for entry in self.entries.values():
+            if entry not in kept:
+                log_.info(f"Library shrunk, dropping {entry.name}")
+        # Kept entries move to the first slots, in the order they were stored
+        kept.sort(key=lambda entry: entry.number)
+        self.reallocate(
+            capacity, self.max_points, {entry.slot: slot for slot, entry in enumerate(kept)}
+        )
+        for slot, entry in enumerate(kept):
+            entry.slot = slot
+        self.entries = {entry.slot: entry for entry in kept}
+        self.save_index()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def load_index(self) -> None:
+        fname = os.path.join(self.path, INDEX_FNAME)
+        try:
+            with open(fname) as f:
+                index = json.load(f)
+            entries = [LibraryEntry(**entry) for entry in index["entries"]]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_.warning(f"Can't read the library index {fname}, starting empty: {e}")
+            return
+        self.entries = {entry.slot: entry for entry in entries}
+        self.clock = index.get("clock", 0)
+        self.next_number = index.get("next_number", len(entries))
+
+    def save_index(self) -> None:
+        if self.path is None:
+            return
+        fname = os.path.join(self.path, INDEX_FNAME)
+        index = dict(
+            clock=self.clock,
+            next_number=self.next_number,
+            entries=[asdict(entry) for entry in self.ordered()],
+        )
+        tmp_fname = f"{fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_fname, fname)
+
+    def ordered(self) -> List[LibraryEntry]:
+        """Entries, oldest first."""
+        return sorted(self.entries.values(), key=lambda entry: entry.number)
+
+    def selected(self) -> List[LibraryEntry]:
+        return [entry for entry in self.ordered() if entry.selected]
+
+    def touch(self, entry: LibraryEntry) -> None:
+        self.clock += 1
+        entry.used = self.clock
+
+    def free_slot(self) -> int:
+        """An empty row, evicting the least recently used entry if there is none."""
+        if len(self.entries) < self.capacity:
+            return next(slot for slot in range(self.capacity) if slot not in self.entries)
+        oldest = min(self.entries.values(), key=lambda entry: entry.used)
+        log_.info(f"Library full, replacing {oldest.name}")
+        del self.entries[oldest.slot]
+        return oldest.slot
+
+    def store(
+        self, y, name: Optional[str] = None, settings: Optional[TraceSettings] = None
+    ) -> LibraryEntry:
+        """Add a trace (volts), selected, returning its entry."""
+        y = np.asarray(y, dtype=np.float32)
+        self.reserve(len(y))
+        slot = self.free_slot()
+        self.traces[slot, : len(y)] = y
+        self.traces[slot, len(y) :] = np.nan
+        if name is None:
+            name = f"Stored Trace {self.next_number}"
+        entry = LibraryEntry(
+            slot=slot,
+            number=self.next_number,
+            name=name,
+            npoints=len(y),
+            created=datetime.now().isoformat(timespec="seconds"),
+            used=0,
+            settings=None if settings is None else settings.model_dump(mode="json"),
+        )
+        self.next_number += 1
+        self.touch(entry)
+        selected = self.selected()
+        excess = max(len(selected) + 1 - self.max_selected, 0)
+        for old in selected[:excess]:
+            old.selected = False
+        self.entries[slot] = entry
+        self.flush()
+        return entry
+
+    def trace(self, entry: LibraryEntry) -> np.ndarray:
+        """The stored trace at full resolution (a view of the library)."""
+        self.touch(entry)
+        return self.traces[entry.slot, : entry.npoints]
+
+    def find(self, name: str) -> LibraryEntry:
+        for entry in self.entries.values():
+            if entry.name == name:
+                return entry
+        raise KeyError(name)
+
+    def select(self, entry: LibraryEntry, selected: bool = True) -> None:
+        entry.selected = selected
+        if selected:
+            self.touch(entry)
+        self.save_index()
+
+    def clear_selection(self) -> None:
+        for entry in self.entries.values():
+            entry.selected = False
+        self.save_index()
+
+    def remove(self, entry: LibraryEntry) -> None:
+        del self.entries[entry.slot]
+        self.traces[entry.slot] = np.nan
+        self.flush()
+
+    def flush(self) -> None:
+        if isinstance(self.traces, np.memmap):
+            self.traces.flush()
+        self.save_index()
+
+    def close(self) -> None:
+        if self.traces is not None:
+            self.flush()
+        if self.lock_file is not None:
+            unlock_directory(self.lock_file)
+            self.lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
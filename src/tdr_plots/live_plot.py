@@ -1,23 +1,24 @@
 from .tdr01_control.common import TraceSettings
 from .tdr01_control.common import Adc
 from .tdr01_control.control import Device
-from .tdr01_control import control
+from .emitter import EmitterThread
+from .storage import save_csv
+from .deconvolution import Deconvolver
+from .history import FrameHistory, PersistenceMap
+from .library import TraceLibrary, minmax_decimate
+from .profiling import profiler
 from typing import List, Union
+import itertools
 import logging
 import queue
 import time
-import random
-import threading
-import csv
 from datetime import datetime
-import tkinter as tk
-from tkinter import filedialog
 
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Button
-from matplotlib import animation
 from matplotlib.lines import Line2D
+from matplotlib.colors import PowerNorm
 from matplotlib.ticker import MaxNLocator
 import mplcursors
 
@@ -30,10 +31,25 @@ GRID_COLOR = (0, 1, 0, 0.1)
 CURSOR_COLOR = (0, 1, 0, 0.75)
 TRACE_COLOR = (0, 1, 0, 0.75)
 LABEL_FONTSIZE = 12
+WATERFALL_CMAP = "viridis"
+PERSISTENCE_CMAP = "inferno"
+HISTORY_MODES = ("off", "waterfall", "persistence")
+HISTORY_DEPTH = 500
 
 log_ = logging.getLogger("monitor_tdr")
 
 
+def _padded(x, npoints: int) -> np.ndarray:
+    """x filled out to npoints with NaN (so as floats) if it is shorter."""
+    if x is not None and len(x) >= npoints:
+        return np.asarray(x)[:npoints]
+    padded = np.full(npoints, np.nan)
+    if x is not None:
+        x = np.asarray(x, dtype=float)[:npoints]
+        padded[: len(x)] = x
+    return padded
+
+
 def create_styled_button(
     ax,
     label,
@@ -69,20 +85,9 @@ def create_styled_button(
     return button
 
 
-def save_csv(fname, rxdac, ramp_time, traces):
-    with open(fname, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        header_row = ["rxdac (dac)", "time (ps)"]
-        for i, _ in enumerate(traces):
-            header_row.append(f"Trace_{i}")
-        writer.writerow(header_row)
-
-        for line in zip(rxdac, ramp_time, *traces):
-            writer.writerow(line)
-    log_.info(f"Saved trace data to {fname}")
-
-
 def get_filename() -> Union[str, None]:
+    from tkinter import filedialog  # pylint: disable=import-outside-toplevel
+
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     default_fname = f"tdr_trace_{timestamp}.csv"
     fname = filedialog.asksaveasfilename(
@@ -100,74 +105,26 @@ def get_filename() -> Union[str, None]:
     return fname
 
 
-class EmitterThread:
-    def __init__(self, device: Device, data_queue, settings: TraceSettings, **kwargs):
-        self.device: Device = device
-        self.data_queue = data_queue
-        self.settings = settings
-        self.sleep_time = kwargs.get("sleep_time", 0)
-        self.thread = None
-        self.stop_event = threading.Event()
-
-    def trace_thread(self):
-        if self.device is None:
-            while not self.stop_event.is_set():
-                self.dummy_thread()
-
-        while not self.stop_event.is_set():
-            trace = control.take_trace(self.device, npoints=self.settings.npoints)
-            trace = [int(pt) for pt in trace]
-            log_.debug(trace)
-            self.data_queue.put(trace)
-            time.sleep(self.sleep_time)
-
-    def dummy_thread(self):
-        """Simulate data reading from a serial port in a separate thread."""
-        # Simulate delay for reading from serial port (10Hz rate)
-        time.sleep(1)
-        # Simulate reading a random value (replace with serial read)
-        trace = [int(1 << 15) * random.random() for _ in range(self.settings.npoints)]
-        # Put data into the queue (either a real serial read or simulated data)
-        self.data_queue.put(trace)
-        # data_queue.put('x')  # Put data into the queue (either a real serial read or simulated data)
-
-    def stop(self):
-        if self.thread is not None and self.thread.is_alive():
-            log_.info("Stop thread")
-            self.stop_event.set()
-            if self.thread:
-                self.thread.join()
-            self.stop_event.clear()
-            log_.info("Thread stopped")
-
-    def start(self):
-        if self.thread is None or not self.thread.is_alive():
-            log_.info("Start thread")
-
-            self.thread = threading.Thread(target=self.trace_thread)
-            self.thread.daemon = (
-                True  # Ensure thread closes when the main program exits
-            )
-            self.thread.start()
-
-    def start_dummy(self, *args):
-        if self.thread is not None and self.thread.is_alive():
-            return
-
-        log_.info("Start thread")
-
-        self.thread = threading.Thread(target=self.dummy_thread)
-        self.thread.daemon = True  # Ensure thread closes when the main program exits
-        self.thread.start()
-
-
 class Scope:
-    def __init__(self, ax, dt=10, settings=None, rxdac=None, data_queue=None):
+    def __init__(
+        self,
+        ax,
+        dt=10,
+        settings=None,
+        rxdac=None,
+        data_queue=None,
+        reference=None,
+        history_depth=HISTORY_DEPTH,
+        library=None,
+    ):
         self.ax = ax
         self.dt = dt
         self.settings = settings or TraceSettings()
         self.rxdac = rxdac
-        self.stored_lines = []
+        # Stored traces, only the selected ones are drawn (by entry number, as
+        # the library reuses the slots of evicted entries)
+        self._library = library  # an in memory one is only made when first used
+        self.stored_lines = {}
         self.line = Line2D([0], [0], marker="o", markersize=3)
         self.ax.add_line(self.line)
         self.default_ylim = (1, 3)
@@ -178,9 +135,36 @@ class Scope:
         self.annotations = []  # List to store annotations
         self.ax.grid(True, color=GRID_COLOR, linestyle="--", linewidth=0.5)
         self.plot_volts = False
+        # Measured step to deconvolve the traces against
+        self.reference = reference
+        self.deconvolver = None
+        self.deconvolve = False
+        # Last history_depth frames for the waterfall and persistence views
+        self.history = None
+        self.history_depth = history_depth
+        self.history_mode = HISTORY_MODES[0]
+        self.history_ax = None
+        self.history_image = None
+        self.history_marker = None
+        self.persistence = None
+        # Text artist for the rolling timing summary with --profile
+        self.profile_text = None
         self.ax.callbacks.connect("xlim_changed", self.on_xlim_change)
 
         self._init_cursors()
+        self.show_stored()
+
+    @property
+    def library(self) -> TraceLibrary:
+        if self._library is None:
+            self._library = TraceLibrary()
+        return self._library
+
+    def stored_entries(self) -> list:
+        """The selected library entries, without making a library to find none."""
+        if self._library is None:
+            return []
+        return self._library.selected()
 
     def _init_cursors(self):
         self.cid_press = self.ax.figure.canvas.mpl_connect(
@@ -229,11 +213,23 @@ class Scope:
     def save_csv(self, *args):
         fname = get_filename()
         if fname:
-            traces = [self.line.get_ydata()]
-            for trace in self.stored_lines:
-                traces.append(trace.get_ydata())
+            y = self.line.get_ydata()
+            traces = [y]
+            for entry in self.stored_entries():
+                if not self.on_live_grid(entry):
+                    log_.warning(f"Not saving {entry.name}, it was taken at another spacing or start")
+                    continue
+                traces.append(self.library.trace(entry))
+            # Every column at full length, NaN past the end of the shorter ones
+            npoints = max(len(trace) for trace in traces)
+            ramp_time = np.arange(npoints) * float(self.dt)
+            if not self.plot_volts:
+                ramp_time[: len(y)] = self.line.get_xdata()[:npoints]
             save_csv(
-                fname, rxdac=self.rxdac, ramp_time=self.line.get_xdata(), traces=traces
+                fname,
+                rxdac=_padded(self.rxdac, npoints),
+                ramp_time=ramp_time,
+                traces=[_padded(trace, npoints) for trace in traces],
             )
 
     def clear_annotations(self, *args):
@@ -244,59 +240,255 @@ class Scope:
         plt.draw()
 
     def store(self, *args):
-        # self.stored_lines.append(copy.deepcopy(self.line))
-        (stored_line,) = self.ax.plot(
-            self.line.get_xdata(),
-            self.line.get_ydata(),
-            ".--",
-            label=f"Stored Trace {len(self.stored_lines)}",
-        )
-        self.stored_lines.append(stored_line)
+        y = self.line.get_ydata()
+        if len(y) < 2:
+            log_.warning("No trace to store")
+            return
+        try:
+            self.library.store(y, settings=self.settings)
+        except OSError as e:
+            log_.error(f"Can't store the trace: {e}")
+            return
+        self.show_stored()
         plt.draw()
 
     def clear_stored(self, *args):
-        """Clear all stored traces."""
-        for line in self.stored_lines:
-            line.remove()  # Remove the stored lines from the plot
-
-        # del line
-        self.stored_lines = []  # Clear the stored lines list
+        """Hide all stored traces, they stay in the library."""
+        self.library.clear_selection()
+        self.show_stored()
         plt.draw()
 
-    def update(self, frame):
-        log_.debug("update %d", frame)
-        try:
-            y = self.data_queue.get_nowait()  # Non-blocking get from the queue
-        except queue.Empty:
-            return (self.line,)
+    def browse_stored(self, *args):
+        """Show only the next older library entry, wrapping to the newest."""
+        entries = self.library.ordered()
+        if not entries:
+            log_.warning("The library is empty")
+            return
+        selected = [entry.number for entry in self.library.selected()]
+        older = [entry for entry in entries if selected and entry.number < min(selected)]
+        entry = older[-1] if older else entries[-1]
+        self.library.clear_selection()
+        self.library.select(entry)
+        log_.info(f"Showing {entry.name} ({entry.created})")
+        self.show_stored()
+        plt.draw()
 
-        adc = Adc()
-        y = adc.to_volts(np.array(y)) / self.settings.naverages
+    def on_live_grid(self, entry) -> bool:
+        """Whether a stored trace was taken at the live trace's spacing, start and ramp."""
+        stored = entry.settings or {}
+        return (
+            stored.get("spacing", self.dt) == self.dt
+            and stored.get("i_start", self.settings.i_start) == self.settings.i_start
+            and stored.get("ramp_mode", self.settings.ramp_mode) == self.settings.ramp_mode
+        )
 
+    def stored_axis(self, entry, npoints):
+        """
+        x of a stored trace, from its own spacing and start (relative to the
+        live trace's). Against the RXDAC table only a trace taken on the live
+        grid can be drawn, None for the others.
+        """
         if self.plot_volts:
-            t = self.rxdac
-            self.ax.set_xlabel("Ramp DAC Setting", fontsize=LABEL_FONTSIZE)
-        else:
-            t = np.array(range(len(y))) * self.dt
-            self.ax.set_xlabel("Time (ps)", fontsize=LABEL_FONTSIZE)
+            if not self.on_live_grid(entry):
+                return None
+            return np.asarray(self.rxdac)[:npoints]
+        stored = entry.settings or {}
+        spacing = stored.get("spacing", self.dt)
+        offset = stored.get("i_start", self.settings.i_start) - self.settings.i_start
+        return (offset + np.arange(npoints)) * float(spacing)
+
+    def show_stored(self, redraw=False):
+        """Draw the selected library entries, decimated, and drop the rest."""
+        selected = {entry.number: entry for entry in self.stored_entries()}
+        for number in list(self.stored_lines):
+            if redraw or number not in selected:
+                self.stored_lines.pop(number).remove()
+        for number, entry in selected.items():
+            if number in self.stored_lines:
+                continue
+            y = self.library.trace(entry)
+            t = self.stored_axis(entry, len(y))
+            if t is None:
+                log_.info(f"{entry.name} was taken at other settings, not drawn against RXDAC")
+                continue
+            t, y = minmax_decimate(t, y[: len(t)])
+            (self.stored_lines[number],) = self.ax.plot(t, y, ".--", label=entry.name)
+
+    def drain(self) -> list:
+        """Every frame waiting on the queue, oldest first."""
+        frames = []
+        try:
+            while True:
+                frames.append(self.data_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return frames
 
-        self.line.set_data(t, y)
-        self.line.set_color(TRACE_COLOR)
+    def update(self, frame):
+        log_.debug("update %d", frame)
+        # Show the newest frame; the ones it overtook only go into the history
+        frames = self.drain()
+        if not frames:
+            return (self.line,)
+        trace = frames[-1]
+        frames = [f for f in frames if len(f.data) == len(trace.data)]
+        if len(frames) > 1:
+            log_.debug("Skipped %d frames", len(frames) - 1)
+
+        if profiler.enabled:
+            profiler.record("queue wait", time.time() - trace.timestamp)
+
+        with profiler.span("convert"):
+            adc = Adc()
+            naverages = np.array([f.naverages or self.settings.naverages for f in frames])
+            data = np.stack([np.asarray(f.data) for f in frames])
+            volts = adc.to_volts(data) / naverages[:, None]
+
+            if self.plot_volts:
+                t = self.rxdac
+                self.ax.set_xlabel("Ramp DAC Setting", fontsize=LABEL_FONTSIZE)
+            else:
+                t = np.array(range(volts.shape[-1])) * self.dt
+                self.ax.set_xlabel("Time (ps)", fontsize=LABEL_FONTSIZE)
+                if self.deconvolve:
+                    t, volts = self.deconvolved(t, volts)
+            y = volts[-1]
+
+        with profiler.span("artists"):
+            for row in volts:
+                self.update_history(t, row)
+            self.line.set_data(t, y)
+            self.line.set_color(TRACE_COLOR)
+            if self.profile_text is not None and trace.seq % 10 == 0:
+                self.profile_text.set_text(profiler.format_summary())
         if self.xlim is None:
             self.xlim = [0, max(t) + abs(max(t)) / 50]
             self.ax.set_xlim(*self.xlim)
             self.on_xlim_change(self.ax)
-        return self.line, *self.stored_lines
+        return self.line, *self.stored_lines.values()
+
+    def deconvolved(self, t, volts):
+        """Deconvolve a (ntraces, npoints) batch of traces."""
+        if self.deconvolver is None or len(self.deconvolver.t) != len(t):
+            try:
+                self.deconvolver = Deconvolver(self.reference, t)
+            except ValueError as e:
+                log_.error(f"Can't deconvolve: {e}")
+                self.deconvolve = False
+                return t, volts
+        return self.deconvolver.t, self.deconvolver(volts)
+
+    def on_deconvolve(self, *args):
+        """
+        Toggle deconvolving the live trace. Without a reference step loaded
+        the trace on screen is taken as the reference.
+        """
+        y = self.line.get_ydata()
+        if not self.deconvolve and self.reference is None:
+            if len(y) < 2:
+                log_.warning("No trace to use as the deconvolution reference")
+                return
+            log_.info("Using the current trace as the deconvolution reference")
+            self.reference = np.array(y)
+        if not self.deconvolve and len(y) > 1 and len(self.reference) != len(y):
+            log_.error(
+                f"Can't deconvolve: the reference has {len(self.reference)} points, "
+                f"the trace {len(y)}"
+            )
+            return
+        self.deconvolve = not self.deconvolve
+
+    def update_history(self, t, y):
+        """Add the frame to the history, redrawing one row/column of the image."""
+        if self.history is None or self.history.npoints != len(y):
+            self.clear_history_view()
+            self.history = FrameHistory(self.history_depth, len(y))
+        row, evicted = self.history.append(y)
+        if self.history_mode == "off":
+            return
+        if self.history_image is None:
+            self.draw_history(t)
+            return
+
+        if self.history_mode == "waterfall":
+            self.history_image.get_array()[row] = y
+            self.history_marker.set_ydata([row + 0.5, row + 0.5])
+        else:
+            # The map's counts are the image's own array, see draw_history
+            if evicted is not None:
+                self.persistence.add(evicted, weight=-1)
+            self.persistence.add(y)
+        self.history_image.changed()
+
+    def draw_history(self, t):
+        extent = (t[0], t[-1])
+        if self.history_mode == "waterfall":
+            self.history_ax = self.ax.figure.add_axes(self.ax.get_position())
+            self.history_image = self.history_ax.imshow(
+                self.history.frames,
+                aspect="auto",
+                origin="lower",
+                interpolation="nearest",
+                extent=(*extent, 0, self.history.depth),
+                cmap=WATERFALL_CMAP,
+                vmin=min(self.default_ylim),
+                vmax=max(self.default_ylim),
+            )
+            row = (self.history.head - 1) % self.history.depth
+            self.history_marker = self.history_ax.axhline(
+                row + 0.5, color=CURSOR_COLOR, linestyle="--", lw=1
+            )
+            self.history_ax.set_xlabel(self.ax.get_xlabel(), fontsize=LABEL_FONTSIZE)
+            self.history_ax.set_ylabel("Capture (ring row)", fontsize=LABEL_FONTSIZE)
+            self.ax.set_visible(False)
+        else:
+            xlim = self.ax.get_xlim()
+            ylim = self.ax.get_ylim()
+            self.persistence = PersistenceMap(self.history.npoints, ylim=ylim)
+            self.persistence.fill(self.history.ordered())
+            self.history_image = self.ax.imshow(
+                self.persistence.counts,
+                aspect="auto",
+                origin="lower",
+                interpolation="nearest",
+                extent=(*extent, *ylim),
+                cmap=PERSISTENCE_CMAP,
+                norm=PowerNorm(0.3, vmin=0, vmax=self.history.depth),
+                zorder=0,
+            )
+            # Update the image's copy of the counts in place from now on
+            self.persistence.counts = self.history_image.get_array().data
+            self.ax.set_xlim(*xlim)
+            self.ax.set_ylim(*ylim)
+
+    def clear_history_view(self):
+        if self.history_image is not None:
+            self.history_image.remove()
+        if self.history_ax is not None:
+            self.history_ax.remove()
+        self.history_ax = None
+        self.history_image = None
+        self.history_marker = None
+        self.persistence = None
+        self.ax.set_visible(True)
+
+    def on_history(self, *args):
+        """Cycle between the live trace, waterfall and persistence views."""
+        index = HISTORY_MODES.index(self.history_mode)
+        self.history_mode = HISTORY_MODES[(index + 1) % len(HISTORY_MODES)]
+        self.clear_history_view()
+        log_.info(f"History view: {self.history_mode}")
+        plt.draw()
 
     def on_use_volts(self, *args):
         self.plot_volts = not self.plot_volts
         self.xlim = None
         self.ax.set_ylim(*self.default_ylim)
 
-        for line in self.stored_lines + [self.line]:
-            y = line.get_ydata()
-            t = self.rxdac if self.plot_volts else np.asarray(range(len(y))) * self.dt
-            line.set_xdata(t)
+        y = self.line.get_ydata()
+        t = self.rxdac if self.plot_volts else np.asarray(range(len(y))) * self.dt
+        self.line.set_xdata(t)
+        self.show_stored(redraw=True)
 
         if self.xlim is None:
             self.xlim = [0, max(t) + abs(max(t)) / 50]
@@ -355,10 +547,31 @@ class Scope:
         self.cursor_text.set_text(f"Δx={dx:.3f}, Δy={dy:.3f}")
 
 
-def run_monitor_plot(settings: TraceSettings, rxdac: List[int], device: Device):
+def run_monitor_plot(
+    settings: TraceSettings,
+    rxdac: List[int],
+    device: Device,
+    use_process: bool = False,
+    source=None,
+    reference=None,
+    profile_fname=None,
+    rate: float = 1,
+    averaging=None,
+    gate=None,
+    check=None,
+    library=None,
+):
     data_queue = queue.Queue()
     emitter_thread = EmitterThread(
-        data_queue=data_queue, settings=settings, device=device
+        data_queue=data_queue,
+        settings=settings,
+        device=device,
+        use_process=use_process,
+        source=source,
+        rate=rate,
+        averaging=averaging,
+        gate=gate,
+        check=check,
     )
 
     def handle_close(event):
@@ -369,6 +582,8 @@ def run_monitor_plot(settings: TraceSettings, rxdac: List[int], device: Device):
             and emitter_thread.thread.is_alive()
         ):
             emitter_thread.stop()
+        profiler.dump(profile_fname)
+        scope.library.close()
         plt.close("all")
 
     fig, ax = plt.subplots()
@@ -377,8 +592,27 @@ def run_monitor_plot(settings: TraceSettings, rxdac: List[int], device: Device):
     # ax.set_xlabel("Offset Time (ps)", fontsize=LABEL_FONTSIZE)
 
     scope = Scope(
-        ax, dt=settings.spacing, settings=settings, rxdac=rxdac, data_queue=data_queue
+        ax,
+        dt=settings.spacing,
+        settings=settings,
+        rxdac=rxdac,
+        data_queue=data_queue,
+        reference=reference,
+        library=library,
     )
+    # Widen the library now rather than on the first Store
+    scope.library.reserve(settings.npoints)
+    if profiler.enabled:
+        scope.profile_text = fig.text(
+            0.01, 0.01, "", fontsize=8, family="monospace", verticalalignment="bottom"
+        )
+        canvas_draw = fig.canvas.draw
+
+        def timed_draw(*args, **kwargs):
+            with profiler.span("canvas draw"):
+                return canvas_draw(*args, **kwargs)
+
+        fig.canvas.draw = timed_draw
     # Start the emitter thread to simulate serial data reading
 
     # Enable multiple points selection
@@ -400,10 +634,13 @@ def run_monitor_plot(settings: TraceSettings, rxdac: List[int], device: Device):
         ("Start/Stop", on_start_stop),
         ("Store", scope.store),
         ("Clear", scope.clear_stored),
+        ("Library", scope.browse_stored),
         ("Save CSV", scope.save_csv),
         ("Clear Annotations", scope.clear_annotations),
         ("Volts/Time", scope.on_use_volts),
         ("Cursors", scope.on_cursors),
+        ("Deconvolve", scope.on_deconvolve),
+        ("History", scope.on_history),
     )
 
     button_xmargin = 0.05
@@ -429,6 +666,8 @@ def run_monitor_plot(settings: TraceSettings, rxdac: List[int], device: Device):
     manager = plt.get_current_fig_manager()
     manager.set_window_title(_FRAME_TITLE)
 
+    import tkinter as tk  # pylint: disable=import-outside-toplevel
+
     root = tk.Tk()
     screen_width = root.winfo_screenwidth()
     screen_height = root.winfo_screenheight()
@@ -436,12 +675,24 @@ def run_monitor_plot(settings: TraceSettings, rxdac: List[int], device: Device):
 
     manager.resize(screen_width, screen_height)
 
-    #  the animation has to be set as a variable
+    # Redraw only when a frame has arrived, so an idle or gated stream costs nothing
+    updates = itertools.count()
+
+    def poll():
+        if data_queue.empty():
+            return
+        scope.update(next(updates))
+        fig.canvas.draw_idle()
+
+    #  the timer has to be kept in a variable
     try:
-        ani = animation.FuncAnimation(
-            fig, scope.update, interval=200, blit=False, save_count=1000
-        )
-        plt.show()
+        timer = fig.canvas.new_timer(interval=200)
+        timer.add_callback(poll)
+        timer.start()
+        # The emitter thread runs here unless acquisition is in its own process
+        in_process = use_process and source is None
+        with profiler.thread_profile("gui", defer_to=None if in_process else "emitter"):
+            plt.show()
     except Exception as e:
         log_.info(f"CAPTURED EXCEPTION {e}")
         raise
@@ -0,0 +1,163 @@
+"""
+monitor.py: Pass/fail checks of live frames against golden reference traces.
+
+Each frame is compared to every golden trace at once and judged against
+the closest one (lowest RMS deviation), so several acceptable references
+can be loaded. The checks are limits on the maximum absolute and the RMS
+deviation inside a time window, plus an optional per point tolerance band.
+Nothing here needs matplotlib.
+"""
+
+from dataclasses import dataclass, field
+import logging
+import queue
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from .tdr01_control.common import Adc
+
+log_ = logging.getLogger("monitor_tdr")
+
+_POLL_TIME = 0.1
+
+
+@dataclass
+class Limits:
+    max_abs: Optional[float] = None  # V
+    rms: Optional[float] = None  # V
+    window: Optional[Tuple[float, float]] = None  # (start, stop) on the golden time axis
+
+
+@dataclass
+class CheckResult:
+    passed: np.ndarray  # (ntraces,) bool
+    golden: np.ndarray  # index of the closest golden trace
+    max_abs: np.ndarray
+    rms: np.ndarray
+    violations: np.ndarray  # points outside the tolerance band
+    seq: Optional[int] = None
+
+    def __bool__(self):
+        return bool(np.all(self.passed))
+
+
+@dataclass
+class ReferenceMonitor:
+    golden: np.ndarray  # (ngolden, npoints) volts
+    t: np.ndarray  # (npoints,)
+    limits: Limits = field(default_factory=Limits)
+    tolerance: Optional[np.ndarray] = None  # (npoints,) or scalar, V
+    naverages: int = 1
+    on_fail: List[Callable[[CheckResult], None]] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.golden = np.atleast_2d(np.asarray(self.golden, dtype=float))
+        self.t = np.asarray(self.t, dtype=float)
+        window = np.ones(len(self.t), dtype=bool)
+        if self.limits.window is not None:
+            start, stop = self.limits.window
+            window = (self.t >= start) & (self.t <= stop)
+        self.window = window
+        self.golden_window = self.golden[:, window]
+        self.tolerance_window = None
+        if self.tolerance is not None:
+            self.tolerance_window = np.broadcast_to(self.tolerance, self.t.shape)[window]
+        self.gain = Adc().to_volts(1) / self.naverages
+
+    def to_volts(self, frames, naverages: Optional[int] = None) -> np.ndarray:
+        """Raw ADC sums to volts, the same scaling as the plot."""
+        gain = self.gain if naverages is None else Adc().to_volts(1) / naverages
+        return np.atleast_2d(np.asarray(frames, dtype=float)) * gain
+
+    def check_volts(self, volts) -> CheckResult:
+        volts = np.atleast_2d(np.asarray(volts, dtype=float))[:, self.window]
+        # (ntraces, ngolden, npoints)
+        deviation = np.abs(volts[:, None, :] - self.golden_window[None, :, :])
+        rms = np.sqrt(np.mean(deviation**2, axis=-1))
+        golden = np.argmin(rms, axis=-1)
+        rows = np.arange(len(volts))
+        deviation = deviation[rows, golden]
+        rms = rms[rows, golden]
+        max_abs = deviation.max(axis=-1)
+
+        passed = np.ones(len(volts), dtype=bool)
+        if self.limits.max_abs is not None:
+            passed &= max_abs <= self.limits.max_abs
+        if self.limits.rms is not None:
+            passed &= rms <= self.limits.rms
+        violations = np.zeros(len(volts), dtype=int)
+        if self.tolerance_window is not None:
+            violations = np.count_nonzero(deviation > self.tolerance_window, axis=-1)
+            passed &= violations == 0
+
+        return CheckResult(
+            passed=passed, golden=golden, max_abs=max_abs, rms=rms, violations=violations
+        )
+
+    def check(
+        self, frames, seq: Optional[int] = None, naverages: Optional[int] = None
+    ) -> CheckResult:
+        """Check raw frames, calling the on_fail handlers if any fails."""
+        result = self.check_volts(self.to_volts(frames, naverages))
+        result.seq = seq
+        if not result:
+            for handler in self.on_fail:
+                handler(result)
+        return result
+
+
+def log_failure(result: CheckResult) -> None:
+    for i in np.flatnonzero(~result.passed):
+        log_.warning(
+            "FAIL frame %s: max |dV| %.4f V, rms %.4f V, %d points outside the mask",
+            result.seq if result.seq is not None else i,
+            result.max_abs[i],
+            result.rms[i],
+            result.violations[i],
+        )
+
+
+def run_checks(
+    monitor: ReferenceMonitor,
+    data_queue,
+    nframes: Optional[int] = None,
+    timeout: Optional[float] = None,
+    alive: Optional[Callable[[], bool]] = None,
+) -> Tuple[int, int]:
+    """
+    Check frames from an emitter's queue until nframes have been seen (or
+    forever), no frame arrives within timeout s or alive() says the source
+    has stopped. Returns the number of frames checked and the number failed.
+    """
+    checked = 0
+    failed = 0
+    waited = 0.0
+    while nframes is None or checked < nframes:
+        try:
+            frame = data_queue.get(timeout=_POLL_TIME)
+        except queue.Empty:
+            if alive is not None and not alive():
+                log_.error("The trace source stopped")
+                break
+            waited += _POLL_TIME
+            if timeout is not None and waited >= timeout:
+                log_.error("No frame received within %s s", timeout)
+                break
+            continue
+        except KeyboardInterrupt:
+            log_.info("Checks stopped")
+            break
+        waited = 0.0
+        result = monitor.check(frame.data, seq=frame.seq, naverages=frame.naverages)
+        checked += 1
+        if not result:
+            failed += 1
+        else:
+            log_.info(
+                "PASS frame %d: max |dV| %.4f V, rms %.4f V",
+                frame.seq,
+                result.max_abs[0],
+                result.rms[0],
+            )
+    return checked, failed
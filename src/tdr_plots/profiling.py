@@ -0,0 +1,167 @@
+"""
+profiling.py: Lightweight timing spans across the live pipeline.
+
+The module level `profiler` is disabled by default, in which case a span
+costs one attribute check. Once enabled (monitor_tdr --profile) every
+span's duration is kept in a rolling window per stage, summarised in the
+plot window and written out on exit. With cprofile set the emitter and
+GUI threads each also get their own cProfile. Python >= 3.12 allows only
+one at a time, the acquisition's, as that is where lag usually starts.
+An acquisition process profiles itself and hands its spans and cProfile
+stats back to the plotting process (see emitter.acquisition_process).
+"""
+
+import contextlib
+import cProfile
+from collections import deque
+import json
+import logging
+import marshal
+import sys
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+log_ = logging.getLogger("monitor_tdr")
+
+# cProfile uses sys.monitoring from 3.12, which has room for one profiler
+_ONE_CPROFILE = sys.version_info >= (3, 12)
+
+# Pipeline order, used to sort the summary
+STAGES = (
+    "command write",
+    "serial wait",
+    "parse",
+    "queue wait",
+    "convert",
+    "artists",
+    "canvas draw",
+)
+
+
+class Profiler:
+    def __init__(self, window: int = 500):
+        self.enabled = False
+        self.cprofile = False
+        self.window = window
+        self.spans: Dict[str, Deque[float]] = {}
+        self.totals: Dict[str, int] = {}
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        # cProfile stats of other processes, by thread name
+        self.stats: Dict[str, dict] = {}
+        # Spans kept for another process to collect, if not None
+        self.outbox: Optional[List[Tuple[str, float]]] = None
+        self.lock = threading.Lock()
+
+    def enable(self, cprofile: bool = False) -> None:
+        self.enabled = True
+        self.cprofile = cprofile
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = deque(maxlen=self.window)
+                self.totals[name] = 0
+            self.spans[name].append(seconds)
+            self.totals[name] += 1
+            if self.outbox is not None:
+                self.outbox.append((name, seconds))
+
+    def take_outbox(self) -> List[Tuple[str, float]]:
+        """The spans recorded since the last call, for another process."""
+        with self.lock:
+            spans, self.outbox = self.outbox or [], []
+        return spans
+
+    def profile_stats(self, name: str) -> Optional[dict]:
+        """Picklable stats of a finished thread profile, as dump_stats writes them."""
+        profile = self.profiles.get(name)
+        if profile is None:
+            return None
+        profile.create_stats()
+        return profile.stats
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    @contextlib.contextmanager
+    def thread_profile(self, name: str, defer_to: Optional[str] = None):
+        """
+        cProfile the calling thread for the duration, if enabled. Where only
+        one cProfile can run, a thread with defer_to leaves it to that thread.
+        """
+        if not (self.enabled and self.cprofile):
+            yield
+            return
+        if defer_to is not None and _ONE_CPROFILE:
+            log_.info(f"Only one cProfile can run, profiling {defer_to} rather than {name}")
+            yield
+            return
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Python >= 3.12 allows only one active cProfile per interpreter
+            log_.warning(f"Can't profile the {name} thread: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count and mean/p50/p95/max (ms) of the recent spans of each stage."""
+        with self.lock:
+            spans = {name: np.array(values) for name, values in self.spans.items()}
+            totals = dict(self.totals)
+        order = {name: i for i, name in enumerate(STAGES)}
+        summary = {}
+        for name in sorted(spans, key=lambda n: (order.get(n, len(STAGES)), n)):
+            ms = spans[name] * 1e3
+            summary[name] = {
+                "count": totals[name],
+                "mean_ms": float(ms.mean()),
+                "p50_ms": float(np.percentile(ms, 50)),
+                "p95_ms": float(np.percentile(ms, 95)),
+                "max_ms": float(ms.max()),
+            }
+        return summary
+
+    def format_summary(self) -> str:
+        lines = [f"{'stage':14s} {'mean':>7s} {'p95':>7s} {'max':>7s} ms"]
+        for name, stats in self.summary().items():
+            lines.append(
+                f"{name:14s} {stats['mean_ms']:7.2f} {stats['p95_ms']:7.2f} {stats['max_ms']:7.2f}"
+            )
+        return "\n".join(lines)
+
+    def dump(self, fname: Optional[str]) -> None:
+        """Write the summary as JSON and any thread profiles next to it."""
+        if not self.enabled or fname is None:
+            return
+        with open(fname, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        log_.info(f"Saved timing summary to {fname}")
+        for name, profile in self.profiles.items():
+            stats_fname = f"{fname}.{name}.prof"
+            profile.dump_stats(stats_fname)
+            log_.info(f"Saved {name} thread profile to {stats_fname}")
+        for name, stats in self.stats.items():
+            stats_fname = f"{fname}.{name}.prof"
+            with open(stats_fname, "wb") as f:
+                marshal.dump(stats, f)
+            log_.info(f"Saved {name} process profile to {stats_fname}")
+
+
+profiler = Profiler()
@@ -0,0 +1,82 @@
+"""
+shared_ring.py: Fixed size ring buffer of trace frames in shared memory.
+
+The writer (acquisition process) copies each frame into a slot and then
+publishes the slot's sequence number; the reader copies the slot out and
+checks the sequence number again to detect frames overwritten mid-copy.
+Only the sequence numbers need to cross the process boundary.
+"""
+
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+_SEQ_DTYPE = np.int64
+_FRAME_DTYPE = np.int32
+_EMPTY = -1
+
+
+class SharedFrameRing:
+    """
+    Ring of `nslots` int32 frames of `npoints` each.
+
+    Create with name=None in the owning process, attach in the child with the
+    name of the owner's ring.
+    """
+
+    def __init__(self, npoints: int, nslots: int = 16, name: Optional[str] = None):
+        self.npoints = npoints
+        self.nslots = nslots
+        seq_size = nslots * np.dtype(_SEQ_DTYPE).itemsize
+        size = seq_size + nslots * npoints * np.dtype(_FRAME_DTYPE).itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.seqs = np.ndarray((nslots,), dtype=_SEQ_DTYPE, buffer=self.shm.buf)
+        self.frames = np.ndarray(
+            (nslots, npoints), dtype=_FRAME_DTYPE, buffer=self.shm.buf, offset=seq_size
+        )
+        if self.owner:
+            self.seqs[:] = _EMPTY
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, seq: int, frame) -> None:
+        slot = seq % self.nslots
+        self.seqs[slot] = _EMPTY
+        self.frames[slot, :] = frame
+        self.seqs[slot] = seq
+
+    def read(self, seq: int) -> Optional[np.ndarray]:
+        """Copy out frame `seq`, None if it has already been overwritten."""
+        slot = seq % self.nslots
+        if self.seqs[slot] != seq:
+            return None
+        frame = self.frames[slot].copy()
+        if self.seqs[slot] != seq:
+            return None
+        return frame
+
+    def close(self) -> None:
+        # Drop the numpy views first, the buffer can't be released while exported
+        self.seqs = None
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
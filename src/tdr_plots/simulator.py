@@ -0,0 +1,215 @@
+"""
+simulator.py: A stand in for the TDR01 and its serial link.
+
+SyntheticLine models the traces of a cable, used by --dummy.
+SimulatedResource answers the SCPI commands the tools use with replies in
+the instrument's ASCII format, parsed by pyvisa exactly as real replies
+are, and optionally holds each reply back for as long as it takes to send
+at the link's baud rate. SimulatedDevice is a Device which opens one
+instead of a VISA resource.
+"""
+
+from dataclasses import dataclass, field
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pyvisa import util
+from scipy.special import erf
+
+from .analysis import SPEED_OF_LIGHT
+from .tdr01_control.common import Adc
+from .tdr01_control.control import Device
+from .deconvolution import GAUSSIAN_RISE
+
+IDN = "ElectroOptical Innovations,TDR01,SIMULATED,0"
+_BITS_PER_BYTE = 10  # 8n1
+
+
+@dataclass
+class Segment:
+    length: float  # m
+    z: float  # ohms
+
+
+@dataclass
+class SyntheticLine:
+    """
+    A step source driving a chain of transmission line segments.
+
+    Each impedance change reflects part of the step back (single bounce,
+    the transmission losses through earlier interfaces are included). The
+    reflections are attenuated by the line loss and their edges slowed by
+    dispersion the further they travel. The ADC noise is per conversion, so
+    summing naverages conversions improves the SNR by sqrt(naverages).
+    """
+
+    segments: List[Segment] = field(
+        default_factory=lambda: [Segment(0.5, 50), Segment(1.0, 75), Segment(0.5, 50)]
+    )
+    z_source: float = 50
+    z_load: float = float("inf")
+    velocity_factor: float = 0.66
+    rise_time: float = 60  # ps, 10-90%
+    dispersion: float = 20  # ps of extra rise time per m travelled
+    loss: float = 0.05  # fraction of amplitude lost per m travelled
+    launch_time: float = 1000  # ps
+    baseline: float = 1.0  # V
+    amplitude: float = 1.0  # V, open circuit step
+    noise: float = 3  # ADC counts rms per conversion
+    adc: Adc = field(default_factory=Adc)
+    _cache: Optional[Tuple[tuple, np.ndarray]] = field(default=None, init=False, repr=False)
+
+    def edges(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Time (ps), height (V) and rise time (ps) of every step at the source."""
+        velocity = SPEED_OF_LIGHT * self.velocity_factor
+        z = [segment.z for segment in self.segments]
+        lengths = np.array([segment.length for segment in self.segments])
+        z_next = np.array(z[1:] + [self.z_load], dtype=float)
+        z = np.array(z, dtype=float)
+        with np.errstate(invalid="ignore"):
+            rho = np.where(np.isinf(z_next), 1.0, (z_next - z) / (z_next + z))
+        # Round trip transmission through the interfaces before each one
+        transmission = np.cumprod(np.concatenate(([1.0], 1 - rho[:-1] ** 2)))
+        distance = np.cumsum(lengths)
+        incident = self.amplitude * z[0] / (z[0] + self.z_source)
+
+        times = np.concatenate(([0.0], 2 * distance / velocity)) + self.launch_time
+        heights = np.concatenate(
+            ([incident], incident * rho * transmission * (1 - self.loss) ** (2 * distance))
+        )
+        rise = np.hypot(
+            self.rise_time, self.dispersion * np.concatenate(([0.0], 2 * distance))
+        )
+        return times, heights, rise
+
+    def volts(self, t) -> np.ndarray:
+        """Noise free line voltage at times t (ps)."""
+        times, heights, rise = self.edges()
+        sigma = (rise / GAUSSIAN_RISE)[:, None]
+        steps = 0.5 * (1 + erf((np.asarray(t)[None, :] - times[:, None]) / (np.sqrt(2) * sigma)))
+        return self.baseline + heights @ steps
+
+    def clean_counts(self, npoints: int, naverages: int, spacing: float, i_start: int):
+        t = (i_start + np.arange(npoints)) * float(spacing)
+        return self.adc.to_adc(self.volts(t)) * naverages
+
+    def counts(
+        self,
+        npoints: int,
+        naverages: int,
+        rng: np.random.Generator,
+        spacing: float = 10,
+        i_start: int = 0,
+    ) -> np.ndarray:
+        """One trace as the instrument returns it, summed over naverages."""
+        key = (npoints, naverages, spacing, i_start)
+        if self._cache is None or self._cache[0] != key:
+            self._cache = (key, self.clean_counts(*key))
+        noise = rng.standard_normal(npoints) * (self.noise * np.sqrt(naverages))
+        counts = np.rint(self._cache[1] + noise)
+        return np.clip(counts, 0, naverages * self.adc.max).astype(np.int32)
+
+
+class SimulatedResource:
+    def __init__(
+        self,
+        baudrate: Optional[int] = None,
+        line: Optional[SyntheticLine] = None,
+        seed: Optional[int] = None,
+    ):
+        self.baud_rate = baudrate
+        self.timeout = None
+        self.line = line or SyntheticLine()
+        self.rng = np.random.default_rng(seed)
+        self.state = {
+            "POINTS": "2500",
+            "RES": "10",
+            "ISTART": "0",
+            "AVG": "2",
+            "VTX": "18204",
+            "RAMP": "1",
+            "TIMING": "60075 16510 0 0",
+            "E": "0",
+        }
+        self.pending = b""
+
+    @property
+    def npoints(self) -> int:
+        return int(self.state["POINTS"])
+
+    def reply(self, command: str) -> bytes:
+        command = command.strip()
+        if command == "TRACE":
+            data = self.line.counts(
+                self.npoints,
+                int(self.state["AVG"]),
+                self.rng,
+                spacing=float(self.state["RES"]),
+                i_start=int(self.state["ISTART"]),
+            )
+        elif command == "RXDAC?":
+            data = self.rxdac()
+        elif command == "*IDN?":
+            return f"{IDN}\n".encode()
+        elif command.endswith("?"):
+            return f"{self.state.get(command[:-1], '')}\n".encode()
+        else:
+            return b""
+        return (",".join(map(str, np.asarray(data, dtype=int))) + "\n").encode()
+
+    def rxdac(self) -> np.ndarray:
+        """The receive ramp DAC of each point, a * (1 - exp(-t/rc)) as TIMING."""
+        a, rc = (float(value) for value in self.state["TIMING"].split()[:2])
+        if rc <= 0:
+            return np.linspace(1000, 55000, self.npoints).astype(int)
+        index = int(self.state["ISTART"]) + np.arange(self.npoints)
+        t = index * float(self.state["RES"])
+        return np.round(a * -np.expm1(-t / rc)).astype(int)
+
+    def transfer_time(self, nbytes: int) -> float:
+        if not self.baud_rate:
+            return 0
+        return nbytes * _BITS_PER_BYTE / self.baud_rate
+
+    def write(self, message: str):
+        for line in message.splitlines():
+            key, _, value = line.strip().partition(" ")
+            if not key:
+                continue
+            if value:
+                self.state[key] = value
+            else:
+                self.pending = self.reply(key)
+        return len(message)
+
+    def read_raw(self) -> bytes:
+        reply, self.pending = self.pending, b""
+        time.sleep(self.transfer_time(len(reply)))
+        return reply
+
+    def read(self) -> str:
+        return self.read_raw().decode()
+
+    def query(self, message: str) -> str:
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message: str, converter="f", separator=","):
+        self.write(message)
+        return util.from_ascii_block(self.read(), converter=converter, separator=separator)
+
+    def flush(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimulatedDevice(Device):
+    def __init__(self, resource: str = "SIM", baudrate: Optional[int] = None, **kwargs):
+        super().__init__(resource=resource, baudrate=baudrate)
+        self.simulation = kwargs
+
+    def setup(self):
+        self.dev = SimulatedResource(baudrate=self.baudrate, **self.simulation)
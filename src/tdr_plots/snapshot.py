@@ -0,0 +1,257 @@
+"""
+snapshot.py: Headless PNG/SVG snapshots of the scope for dashboards.
+
+SnapshotRenderer draws a Scope on its own Agg figure, so it needs neither
+a display nor Tk. The axes, grid and labels are drawn once and kept as a
+background; a new PNG only restores that and draws the trace over it,
+until the limits change. Each format is rendered at most once per frame
+and the bytes are cached, so any number of readers cost nothing extra.
+
+SnapshotServer serves the latest snapshots over HTTP (/latest.png,
+/latest.svg and an auto refreshing page at /), write_snapshot writes them
+to a directory for anything that watches files. run_snapshots renders
+from the live stream (the newest frame each interval) or a recording.
+"""
+
+import http.server
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from .live_plot import Scope, HISTORY_MODES, LABEL_FONTSIZE
+from .tdr01_control.common import TraceSettings
+
+log_ = logging.getLogger("monitor_tdr")
+
+FORMATS = ("png", "svg")
+CONTENT_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+DEFAULT_HTTP_ADDRESS = ("127.0.0.1", 8080)
+PNG_COMPRESSION = 3  # zlib level, higher is barely smaller and much slower
+
+_PAGE = """<!DOCTYPE html>
+<html><head><title>TDR01</title><style>body{{margin:0;background:#000}}
+img{{width:100vw;height:100vh;object-fit:contain}}</style></head>
+<body><img id="scope" src="latest.{fmt}">
+<script>setInterval(function() {{
+  document.getElementById("scope").src = "latest.{fmt}?" + Date.now();
+}}, {interval_ms});</script></body></html>
+"""
+
+
+class SnapshotRenderer:
+    def __init__(
+        self,
+        settings: TraceSettings,
+        rxdac=None,
+        reference=None,
+        size: Tuple[float, float] = (12, 6),
+        dpi: int = 100,
+        history_mode: str = "off",
+    ):
+        if history_mode not in HISTORY_MODES:
+            raise ValueError(f"history_mode must be one of {HISTORY_MODES}")
+        self.figure = Figure(figsize=size, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot()
+        ax.set_ylabel("RX Volts", fontsize=LABEL_FONTSIZE)
+        self.data_queue = queue.Queue()
+        self.scope = Scope(
+            ax,
+            dt=settings.spacing,
+            settings=settings,
+            rxdac=rxdac,
+            data_queue=self.data_queue,
+            reference=reference,
+        )
+        self.scope.history_mode = history_mode
+        # The trace is drawn over the cached background, not with the figure
+        self.blit = history_mode == "off"
+        self.scope.line.set_animated(self.blit)
+        self.background = None
+        self.limits = None
+        self.seq: Optional[int] = None
+        self.cache: Dict[str, bytes] = {}
+        self.lock = threading.Lock()
+
+    def update(self, frame) -> None:
+        with self.lock:
+            self.data_queue.put(frame)
+            self.scope.update(frame.seq)
+            self.seq = frame.seq
+            self.cache.clear()
+
+    def snapshot(self, fmt: str = "png") -> Optional[bytes]:
+        """The latest frame as fmt, None before the first frame."""
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt}")
+        with self.lock:
+            if self.seq is None:
+                return None
+            if fmt not in self.cache:
+                self.cache[fmt] = self.render_png() if fmt == "png" else self.render_svg()
+            return self.cache[fmt]
+
+    def render_png(self) -> bytes:
+        if not self.blit:
+            return self.savefig("png")
+        ax = self.scope.ax
+        limits = (ax.get_xlim(), ax.get_ylim(), self.canvas.get_width_height())
+        if self.background is None or limits != self.limits:
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+            self.limits = limits
+        else:
+            self.canvas.restore_region(self.background)
+        ax.draw_artist(self.scope.line)
+        # Encoding dominates; the figure is opaque so drop the alpha channel
+        width, height = self.canvas.get_width_height()
+        image = Image.frombuffer("RGBA", (width, height), self.canvas.buffer_rgba())
+        buf = io.BytesIO()
+        image.convert("RGB").save(buf, format="png", compress_level=PNG_COMPRESSION)
+        return buf.getvalue()
+
+    def render_svg(self) -> bytes:
+        self.scope.line.set_animated(False)
+        try:
+            return self.savefig("svg")
+        finally:
+            self.scope.line.set_animated(self.blit)
+
+    def savefig(self, fmt: str) -> bytes:
+        buf = io.BytesIO()
+        self.figure.savefig(buf, format=fmt, facecolor=self.figure.get_facecolor())
+        return buf.getvalue()
+
+
+def write_snapshot(renderer: SnapshotRenderer, directory, fmt: str = "png", sequence=False):
+    """Write latest.fmt (replaced atomically) and with sequence one file per frame."""
+    data = renderer.snapshot(fmt)
+    if data is None:
+        return None
+    fname = os.path.join(directory, f"latest.{fmt}")
+    tmp_fname = f"{fname}.tmp"
+    with open(tmp_fname, "wb") as f:
+        f.write(data)
+    os.replace(tmp_fname, fname)
+    if sequence:
+        fname = os.path.join(directory, f"tdr_{renderer.seq:08d}.{fmt}")
+        with open(fname, "wb") as f:
+            f.write(data)
+    return fname
+
+
+class _SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    renderer: SnapshotRenderer
+    page: bytes
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = self.path.split("?", 1)[0]
+        if path in ("/", "/index.html"):
+            self.reply(200, "text/html", self.page)
+            return
+        name, _, fmt = path.lstrip("/").partition(".")
+        if name != "latest" or fmt not in FORMATS:
+            self.send_error(404)
+            return
+        data = self.renderer.snapshot(fmt)
+        if data is None:
+            self.send_error(503, "No frame yet")
+            return
+        self.reply(200, CONTENT_TYPES[fmt], data, seq=self.renderer.seq)
+
+    def reply(self, code, content_type, data, seq=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        if seq is not None:
+            self.send_header("X-Frame-Seq", str(seq))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log_.debug("%s " + format, self.address_string(), *args)
+
+
+class SnapshotServer:
+    def __init__(
+        self,
+        renderer: SnapshotRenderer,
+        address: Tuple[str, int] = DEFAULT_HTTP_ADDRESS,
+        fmt: str = "png",
+        interval: float = 1.0,
+    ):
+        page = _PAGE.format(fmt=fmt, interval_ms=int(interval * 1000)).encode()
+        handler = type(
+            "SnapshotHandler", (_SnapshotHandler,), {"renderer": renderer, "page": page}
+        )
+        self.httpd = http.server.ThreadingHTTPServer(address, handler)
+        self.httpd.daemon_threads = True
+        self.address = self.httpd.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        log_.info("Serving snapshots on http://%s:%d/", *self.address[:2])
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def latest_frames(data_queue, alive: Callable[[], bool]):
+    """
+    Newest frame on the queue each time round, None if nothing arrived,
+    until alive() says the emitter stopped.
+    """
+    while alive() or not data_queue.empty():
+        frame = None
+        try:
+            while True:
+                frame = data_queue.get_nowait()
+        except queue.Empty:
+            pass
+        yield frame
+
+
+def run_snapshots(
+    renderer: SnapshotRenderer,
+    frames: Iterable,
+    interval: float = 1.0,
+    directory=None,
+    formats=("png",),
+    sequence: bool = False,
+) -> int:
+    """
+    Render one frame from `frames` every interval seconds (None: nothing
+    new, keep the last image) until it ends. Returns the frames rendered.
+    """
+    rendered = 0
+    for frame in frames:
+        start = time.monotonic()
+        if frame is not None:
+            renderer.update(frame)
+            rendered += 1
+            if directory is not None:
+                for fmt in formats:
+                    write_snapshot(renderer, directory, fmt, sequence=sequence)
+        time.sleep(max(interval - (time.monotonic() - start), 0))
+    return rendered
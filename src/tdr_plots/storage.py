@@ -0,0 +1,40 @@
+"""
+storage.py: Reading and writing captured traces.
+"""
+
+import csv
+import importlib.util
+import logging
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+log_ = logging.getLogger("monitor_tdr")
+
+RXDAC_COLUMN = "rxdac (dac)"
+TIME_COLUMN = "time (ps)"
+TRACE_PREFIX = "Trace_"
+# pyarrow's multithreaded reader if it is installed, otherwise pandas' C parser
+CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+
+
+def save_csv(fname, rxdac, ramp_time, traces):
+    with open(fname, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        header_row = [RXDAC_COLUMN, TIME_COLUMN]
+        for i, _ in enumerate(traces):
+            header_row.append(f"{TRACE_PREFIX}{i}")
+        writer.writerow(header_row)
+
+        for line in zip(rxdac, ramp_time, *traces):
+            writer.writerow(line)
+    log_.info(f"Saved trace data to {fname}")
+
+
+def load_csv(fname) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """rxdac, time and the (ntraces, npoints) traces of a save_csv file."""
+    df = pd.read_csv(fname, engine=CSV_ENGINE)
+    columns = [c for c in df.columns if c.startswith(TRACE_PREFIX)]
+    traces = df[columns].to_numpy(dtype=float).T
+    return df[RXDAC_COLUMN].to_numpy(), df[TIME_COLUMN].to_numpy(dtype=float), traces
@@ -63,6 +63,9 @@ class Adc:
     def to_volts(self, adc):
         return (adc / self.npoints) * self.vref
 
+    def to_adc(self, volts):
+        return volts / self.vref * self.npoints
+
 
 class RampModel(BaseModel):
     """
@@ -219,11 +222,69 @@ class Trace(BaseModel):
 
     @property
     def trace_volts(self):
-        vmax = self.settings.ramp_vmax()
+        vmax = self.settings.ramp_vmax
         gain: float = vmax / (self.settings.naverages * self.settings.ramp_adc_max)
         return np.asarray(self.trace) * gain
 
 
+@dataclass
+class TraceBatch:
+    """
+    Traces sharing one configuration stacked as a (ntraces, npoints) array
+    of raw ADC sums.
+    """
+
+    settings: TraceSettings
+    rxdac: np.ndarray
+    traces: np.ndarray
+
+    @classmethod
+    def from_traces(cls, traces: List[Trace]) -> "TraceBatch":
+        return cls(
+            settings=traces[0].settings,
+            rxdac=np.asarray(traces[0].rxdac),
+            traces=np.asarray([trace.trace for trace in traces]),
+        )
+
+    def __len__(self):
+        return len(self.traces)
+
+    @property
+    def t_nominal(self) -> np.ndarray:
+        return time_axis(self.settings, self.rxdac)
+
+    @property
+    def volts(self) -> np.ndarray:
+        return Adc().to_volts(np.asarray(self.traces, dtype=float)) / self.settings.naverages
+
+
+# Scales the median absolute deviation to the standard deviation of a normal
+_MAD_SIGMA = 1.4826
+
+
+def robust_std(x, axis=-1) -> np.ndarray:
+    x = np.asarray(x, dtype=float)
+    median = np.median(x, axis=axis, keepdims=True)
+    return _MAD_SIGMA * np.median(np.abs(x - median), axis=axis)
+
+
+def time_axis(settings: TraceSettings, rxdac=None) -> np.ndarray:
+    """
+    Time of flight (ps) of each point from the ramp model and the RXDAC table.
+    Falls back to the nominal RES x (ISTART + i) grid if there is no table or
+    the model doesn't give a monotonic axis for it (e.g. uncalibrated).
+    """
+    nominal = (settings.i_start + np.arange(settings.npoints)) * float(settings.spacing)
+    if rxdac is None or len(rxdac) != settings.npoints:
+        return nominal
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = settings.ramp_model.calc_time(np.asarray(rxdac, dtype=float))
+    if np.all(np.isfinite(t)) and np.all(np.diff(t) > 0):
+        return t
+    log_.debug("Ramp model time axis is not usable, using the nominal spacing")
+    return nominal
+
+
 def get_nominal_ramp_mode_model(mode):
     """
     Nominal calibration values for linearizing the VBRX values
@@ -1,19 +1,27 @@
 # control.py: Low level device control helper functions
+import contextlib
 import logging
 import time
-from typing import List
+from typing import List, Optional
 import pyvisa
+from pyvisa import util
 
 from .common import (
     Trace,
     TraceSettings,
 )
 
+from . import integrity
+
 log_ = logging.getLogger("tdr_control")
 
 g_rm = pyvisa.ResourceManager("@py")
 
 
+def _no_span(name: str):
+    return contextlib.nullcontext()
+
+
 class Device:
     def __init__(self, resource: str, baudrate: int = 115200, timeout=5e3):
         self.resource = resource
@@ -21,12 +29,18 @@ class Device:
         self.rm = pyvisa.ResourceManager()
         self.dev: pyvisa.Resource = None
         self.timeout = timeout
+        # Context manager factory timing the steps of a transfer by name,
+        # e.g. a profiler's span; no timing by default
+        self.span = _no_span
 
     def __enter__(self):
         self.setup()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
         if self.dev:
             try:
                 self.dev.close()
@@ -64,15 +78,27 @@ class Device:
 
 
 def take_trace(device: Device, npoints=None, command="TRACE") -> List[int]:
-    d = device.dev.query_ascii_values(command, converter="d", separator=",")
+    # query_ascii_values split into its steps so each can be timed
+    with device.span("command write"):
+        device.dev.write(command)
+    with device.span("serial wait"):
+        block = device.dev.read()
+    with device.span("parse"):
+        d = util.from_ascii_block(block, converter="d", separator=",")
     if npoints:
         assert len(d) == npoints
     return d
 
 
 def take_traces(
-    device, ramp_mode: int, settings: TraceSettings, ntraces=1, tsleep=0.1
+    device,
+    ramp_mode: int,
+    settings: TraceSettings,
+    ntraces=1,
+    tsleep=0.1,
+    check: Optional["integrity.FrameCheck"] = None,
 ) -> List[Trace]:
+    trace_settings = settings
     npoints = settings.npoints
     naverages = settings.naverages
     i_start = settings.i_start
@@ -144,18 +170,11 @@ def take_traces(
         log_.info("Starting Trace %d/%d. Ramp: %d", i + 1, ntraces, ramp_mode)
         while True:
             try:
-                trace_data = take_trace(device, npoints=npoints)
-                if len(trace_data) != npoints:
-                    log_.error(
-                        "Trace is wrong length, retaking %d/%d",
-                        len(trace_data),
-                        npoints,
-                    )
-                    continue
+                trace_data = integrity.take_valid_trace(device, trace_settings, check)
                 break
-            except TimeoutError as e:
+            except integrity.CorruptFrameError as e:
                 log_.error(e)
-        trace = Trace(rxdac=rxpoints, trace=trace_data,
+        trace = Trace(rxdac=rxpoints, trace=list(trace_data),
                       settings=dict(settings))
         traces.append(trace)
     return traces
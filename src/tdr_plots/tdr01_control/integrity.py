@@ -0,0 +1,176 @@
+"""
+integrity.py: Plausibility checks on received traces and partial retakes.
+
+A trace is a sum of naverages 12 bit conversions, so anything outside
+0..naverages * 4095 can't be real, and a serial glitch shows up as a few
+points far from their neighbours. Both are found in one vectorized pass
+(the glitch test compares each point with a rolling median, which leaves
+the steps of a real reflection alone). When only part of a trace is bad,
+just that stretch is taken again by pointing ISTART/POINTS at it and the
+result is patched in, rather than repeating the whole acquisition.
+
+A glitch which comes back in the same place on a retake is taken to be
+real signal and kept. A FrameCheck remembers the glitches of the last
+trace it accepted, so a narrow reflection flagged on every frame is only
+retaken once rather than on each of them: serial glitches don't repeat
+in the same place. Use one FrameCheck per stream of traces.
+"""
+
+from dataclasses import dataclass, field
+import logging
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from scipy.ndimage import binary_dilation, median_filter
+
+from .common import Adc, TraceSettings, robust_std
+from . import control
+
+log_ = logging.getLogger("tdr_control")
+
+
+class CorruptFrameError(ValueError):
+    pass
+
+
+@dataclass
+class FrameCheck:
+    glitch_window: int = 9  # samples in the rolling median
+    glitch_sigmas: float = 10.0  # distance from the median counted as a glitch
+    glitch_floor: float = 16.0  # ADC counts per average always allowed
+    pad: int = 4  # samples retaken either side of a bad stretch
+    merge: int = 32  # bad stretches closer than this are retaken together
+    max_bad_fraction: float = 0.25  # retake the whole trace above this
+    retries: int = 3
+    known_jitter: int = 1  # samples a repeated glitch may move between frames
+    # Firmware checksum of a reply, called with the decoded values
+    checksum: Optional[Callable[[np.ndarray], bool]] = None
+    adc: Adc = field(default_factory=Adc)
+    # Glitch mask of the last accepted trace
+    known: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+
+    def glitch_limit(self, residual, naverages: int) -> float:
+        sigma = robust_std(residual)
+        return max(self.glitch_sigmas * sigma, self.glitch_floor * naverages)
+
+    def residual(self, data) -> np.ndarray:
+        data = np.asarray(data, dtype=float)
+        return data - median_filter(data, size=self.glitch_window, mode="nearest")
+
+    def out_of_range(self, data, naverages: int) -> np.ndarray:
+        data = np.asarray(data, dtype=float)
+        return ~np.isfinite(data) | (data < 0) | (data > naverages * self.adc.max)
+
+    def bad_points(self, data, naverages: int) -> np.ndarray:
+        """Mask of the points which are out of range or glitches."""
+        bad = self.out_of_range(data, naverages)
+        residual = self.residual(np.where(bad, 0, data))
+        return bad | (np.abs(residual) > self.glitch_limit(residual, naverages))
+
+    def unknown(self, bad, data, naverages: int) -> np.ndarray:
+        """The bad points less the glitches the last accepted trace also had."""
+        if self.known is None or len(self.known) != len(bad) or not self.known.any():
+            return bad
+        known = self.known
+        if self.known_jitter:
+            known = binary_dilation(known, iterations=self.known_jitter)
+        return bad & ~(known & ~self.out_of_range(data, naverages))
+
+    def segments(self, bad) -> List[Tuple[int, int]]:
+        """(start, stop) of the padded, merged stretches containing bad points."""
+        index = np.flatnonzero(bad)
+        if len(index) == 0:
+            return []
+        # Split where the gap to the next bad point is too big to bridge
+        breaks = np.flatnonzero(np.diff(index) > self.merge + 2 * self.pad)
+        starts = np.concatenate(([index[0]], index[breaks + 1])) - self.pad
+        stops = np.concatenate((index[breaks], [index[-1]])) + self.pad + 1
+        npoints = len(bad)
+        return list(zip(np.maximum(starts, 0).tolist(), np.minimum(stops, npoints).tolist()))
+
+
+def read_values(device, npoints: int, checksum=None, command="TRACE") -> Optional[np.ndarray]:
+    """One reply, None if it times out, is the wrong length or fails the checksum."""
+    try:
+        values = np.asarray(control.take_trace(device, command=command))
+    except (TimeoutError, ValueError) as e:
+        log_.error(e)
+        return None
+    if len(values) != npoints:
+        log_.error("Reply is wrong length, %d/%d", len(values), npoints)
+        return None
+    if checksum is not None and not checksum(values):
+        log_.error("Reply failed its checksum")
+        return None
+    return values
+
+
+def retake_segment(device, settings: TraceSettings, start: int, stop: int, check: FrameCheck):
+    """Points start:stop of the trace, taken alone."""
+    device.write(f"ISTART {settings.i_start + start}\n")
+    device.write(f"POINTS {stop - start}\n")
+    return read_values(device, stop - start, check.checksum)
+
+
+def repair(
+    device, data, bad, settings: TraceSettings, check: FrameCheck, naverages: int
+) -> Optional[np.ndarray]:
+    """Retake the stretches around the bad points, None if one can't be fixed."""
+    data = np.array(data)
+    try:
+        for start, stop in check.segments(bad):
+            for _ in range(check.retries):
+                segment = retake_segment(device, settings, start, stop, check)
+                if segment is None:
+                    continue
+                patched = data.copy()
+                patched[start:stop] = segment
+                still_bad = check.bad_points(patched, naverages)
+                still_bad = check.unknown(still_bad, patched, naverages)[start:stop]
+                if check.out_of_range(segment, naverages).any():
+                    continue
+                repeated = np.array_equal(still_bad, bad[start:stop])
+                if not still_bad.any() or repeated:
+                    if still_bad.any():
+                        log_.info("Glitch at %d:%d repeated, keeping it", start, stop)
+                    data = patched
+                    break
+            else:
+                return None
+            log_.info("Retook points %d:%d", start, stop)
+    finally:
+        device.write(f"ISTART {settings.i_start}\n")
+        device.write(f"POINTS {settings.npoints}\n")
+    return data
+
+
+def take_valid_trace(
+    device,
+    settings: TraceSettings,
+    check: Optional[FrameCheck] = None,
+    naverages: Optional[int] = None,
+) -> np.ndarray:
+    """
+    A trace which passes the checks, retaking only the bad stretches where
+    possible. Raises CorruptFrameError after check.retries failed attempts.
+    """
+    check = check or FrameCheck()
+    naverages = naverages or settings.naverages
+    npoints = settings.npoints
+    for _ in range(check.retries):
+        data = read_values(device, npoints, check.checksum)
+        if data is None:
+            continue
+        glitches = check.bad_points(data, naverages)
+        bad = check.unknown(glitches, data, naverages)
+        if not bad.any():
+            check.known = glitches
+            return data
+        if bad.mean() > check.max_bad_fraction:
+            log_.error("%d/%d points bad, retaking the trace", bad.sum(), npoints)
+            continue
+        repaired = repair(device, data, bad, settings, check, naverages)
+        if repaired is not None:
+            check.known = check.bad_points(repaired, naverages)
+            return repaired
+    raise CorruptFrameError(f"No valid trace in {check.retries} attempts")
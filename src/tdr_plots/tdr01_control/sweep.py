@@ -0,0 +1,232 @@
+"""
+sweep.py: One high dynamic range trace from several ramp modes.
+
+The fast ramp resolves the near end finely but runs out of reach, the
+slow ramp reaches much further in coarser steps. take_sweep takes the
+traces of each ramp in turn, writing only the settings which change
+between them and reading each ramp's RXDAC? table just once
+(RxdacCache, which can keep the tables in a file between runs). merge_sweep puts the parts on one time axis through their
+RampModels (see common.time_axis): the samples of the shortest reaching
+part where it reaches, then those of each longer reaching part beyond
+the previous ones. Where parts overlap they are crossfaded linearly over
+the last `blend` fraction of the overlap, so the seam doesn't step.
+"""
+
+from dataclasses import dataclass
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .common import Adc, TraceSettings, time_axis
+from . import control
+from . import integrity
+
+log_ = logging.getLogger("tdr_control")
+
+
+@dataclass
+class SweepPart:
+    """The traces (raw ADC sums) taken with one ramp."""
+
+    settings: TraceSettings
+    rxdac: np.ndarray
+    traces: np.ndarray  # (ntraces, npoints)
+
+    @property
+    def t(self) -> np.ndarray:
+        return time_axis(self.settings, self.rxdac)
+
+    @property
+    def volts(self) -> np.ndarray:
+        traces = np.atleast_2d(np.asarray(self.traces, dtype=float))
+        return Adc().to_volts(traces) / self.settings.naverages
+
+
+@dataclass
+class MergedSweep:
+    t: np.ndarray  # ps
+    rxdac: np.ndarray  # of the part each point of the axis was taken from
+    part: np.ndarray  # index in parts of that part
+    volts: np.ndarray  # (ntraces, npoints)
+    weights: np.ndarray  # (nparts, npoints) blend of each part, summing to 1
+
+
+class RxdacCache:
+    """
+    RXDAC? tables by the instrument and settings they depend on, read once
+    per ramp. With a file the tables are kept between runs, so switching
+    ramps doesn't query them again; delete it after changing the ramp DACs.
+    """
+
+    def __init__(self, fname: Optional[str] = None, instrument: str = ""):
+        """instrument: identifies the unit (its *IDN? reply), tables aren't shared between units"""
+        self.fname = fname
+        self.instrument = instrument
+        self.tables: Dict[tuple, np.ndarray] = {}
+        if fname is not None:
+            self.load()
+
+    def key(self, settings: TraceSettings) -> tuple:
+        model = settings.ramp_model
+        return (
+            self.instrument,
+            settings.ramp_mode,
+            settings.spacing,
+            settings.i_start,
+            settings.npoints,
+            model.a,
+            model.rc,
+            settings.va,
+            settings.vb,
+        )
+
+    def load(self) -> None:
+        try:
+            with open(self.fname) as f:
+                tables = json.load(f)
+            self.tables = {tuple(t["key"]): np.asarray(t["rxdac"]) for t in tables}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_.warning("Can't read the RXDAC? cache %s, starting empty: %s", self.fname, e)
+
+    def save(self) -> None:
+        if self.fname is None:
+            return
+        tables = [
+            dict(key=list(key), rxdac=rxdac.tolist()) for key, rxdac in self.tables.items()
+        ]
+        directory = os.path.dirname(self.fname)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_fname = f"{self.fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(tables, f)
+        os.replace(tmp_fname, self.fname)
+
+    def put(self, settings: TraceSettings, rxdac) -> None:
+        key = self.key(settings)
+        rxdac = np.asarray(rxdac)
+        if key in self.tables and np.array_equal(self.tables[key], rxdac):
+            return
+        self.tables[key] = rxdac
+        self.save()
+
+    def get(self, device, settings: TraceSettings) -> np.ndarray:
+        key = self.key(settings)
+        if key not in self.tables:
+            log_.info("Reading RXDAC? for ramp %d", settings.ramp_mode)
+            self.put(
+                settings,
+                control.take_trace(device, command="RXDAC?", npoints=settings.npoints),
+            )
+        return self.tables[key]
+
+
+def ramp_commands(settings: TraceSettings) -> Dict[str, object]:
+    commands = {
+        "RAMP": settings.ramp_mode,
+        "RES": settings.spacing,
+        "ISTART": settings.i_start,
+        "POINTS": settings.npoints,
+        "AVG": settings.naverages,
+    }
+    model = settings.ramp_model
+    # Only calibrated ramps (rc set) replace the instrument's own timing
+    if model.rc:
+        commands["TIMING"] = f"{model.a} {model.rc} 0 0"
+    return commands
+
+
+def configure(device, settings: TraceSettings, state: Optional[dict] = None) -> dict:
+    """Write the settings which differ from state, returns the new state."""
+    state = dict(state or {})
+    for key, value in ramp_commands(settings).items():
+        if state.get(key) != value:
+            command = f"{key} {value}\n"
+            device.write(command)
+            log_.debug(command)
+            state[key] = value
+    return state
+
+
+def take_sweep(
+    device,
+    ramps: Sequence[TraceSettings],
+    cache: Optional[RxdacCache] = None,
+    check: Optional[integrity.FrameCheck] = None,
+    ntraces: int = 1,
+) -> List[SweepPart]:
+    """
+    ntraces traces with each ramp, all of one ramp before switching to the
+    next, leaving the instrument set up for the first ramp.
+    """
+    cache = cache if cache is not None else RxdacCache()
+    state = {}
+    parts = []
+    for settings in ramps:
+        state = configure(device, settings, state)
+        rxdac = cache.get(device, settings)
+        traces = []
+        for _ in range(ntraces):
+            if check is not None:
+                traces.append(integrity.take_valid_trace(device, settings, check))
+            else:
+                traces.append(control.take_trace(device, npoints=settings.npoints))
+        parts.append(SweepPart(settings, rxdac, np.asarray(traces)))
+    configure(device, ramps[0], state)
+    return parts
+
+
+def interp_rows(t, tp, yp) -> np.ndarray:
+    """np.interp of every row of yp (..., len(tp)) at t, held at the ends."""
+    index = np.clip(np.searchsorted(tp, t), 1, len(tp) - 1)
+    frac = np.clip((t - tp[index - 1]) / (tp[index] - tp[index - 1]), 0, 1)
+    return yp[..., index - 1] * (1 - frac) + yp[..., index] * frac
+
+
+def merge_sweep(parts: Sequence[SweepPart], blend: float = 0.2) -> MergedSweep:
+    """Merge the parts of a sweep onto one axis, see the module docstring."""
+    if not 0 <= blend <= 1:
+        raise ValueError("blend must be between 0 and 1")
+    axes = [part.t for part in parts]
+    order = sorted(range(len(parts)), key=lambda k: axes[k][-1])
+
+    pieces = []
+    end = -np.inf
+    for k in order:
+        index = np.flatnonzero(axes[k] > end)
+        pieces.append((k, index))
+        end = axes[k][-1]
+    t = np.concatenate([axes[k][index] for k, index in pieces])
+    part = np.concatenate([np.full(len(index), k) for k, index in pieces])
+    rxdac = np.concatenate([np.asarray(parts[k].rxdac)[index] for k, index in pieces])
+
+    weights = np.zeros((len(parts), len(t)))
+    first = order[0]
+    start, end = axes[first][0], axes[first][-1]
+    weights[first] = (t >= start) & (t <= end)
+    done = [first]
+    for k in order[1:]:
+        tk = axes[k]
+        covered = (t >= start) & (t <= end)
+        inside = (t >= tk[0]) & (t <= tk[-1])
+        fade_start = end - blend * (end - max(start, tk[0]))
+        if end > fade_start:
+            fade = np.clip((t - fade_start) / (end - fade_start), 0, 1)
+        else:
+            fade = (t > end).astype(float)
+        fade = np.where(covered, fade, 1.0) * inside
+        weights[done] *= 1 - fade
+        weights[k] = fade
+        done.append(k)
+        start, end = min(start, tk[0]), max(end, tk[-1])
+
+    volts = 0
+    for k, part_k in enumerate(parts):
+        values = interp_rows(t, axes[k], part_k.volts)
+        volts = volts + np.where(weights[k] > 0, values * weights[k], 0)
+    return MergedSweep(t=t, rxdac=rxdac, part=part, volts=volts, weights=weights)
@@ -1,6 +1,41 @@
+import os
+import queue
+import tempfile
+import time
 import unittest
-from tdr_plots.live_plot import save_csv
+import unittest.mock
+import urllib.request
+from tdr_plots.live_plot import Scope, save_csv
+from tdr_plots.shared_ring import SharedFrameRing
+from tdr_plots.emitter import EmitterThread, Frame, queued_frames
+from tdr_plots import broadcast
+from tdr_plots import analysis
+from tdr_plots.deconvolution import deconvolve
+from tdr_plots import monitor
+from tdr_plots.history import FrameHistory, PersistenceMap
+from tdr_plots.simulator import SimulatedDevice, SyntheticLine, Segment
+from tdr_plots.tdr01_control.control import take_trace
+from tdr_plots.tdr01_control.integrity import FrameCheck, take_valid_trace
+from tdr_plots.tdr01_control.sweep import RxdacCache, merge_sweep, take_sweep
+from tdr_plots.profiling import Profiler
+from tdr_plots.averaging import AdaptiveAveraging
+from tdr_plots.gating import ChangeGate
+from tdr_plots import batch
+from tdr_plots.library import LibraryLockedError, TraceLibrary, minmax_decimate
+from tdr_plots.snapshot import SnapshotRenderer, SnapshotServer
+from scipy.special import erf
+from tdr_plots.tdr01_control.common import TraceSettings
+import numpy as np
 import pandas as pd
+from matplotlib.figure import Figure
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.001)
 
 
 class TestPlots(unittest.TestCase):
@@ -14,6 +49,536 @@ class TestPlots(unittest.TestCase):
         self.assertEqual(tuple(df["Trace_1"]), (2,2,2))
 
 
+class TestSharedRing(unittest.TestCase):
+    def test_write_read(self):
+        with SharedFrameRing(npoints=4, nslots=2) as ring:
+            ring.write(0, [1, 2, 3, 4])
+            ring.write(1, [5, 6, 7, 8])
+            self.assertEqual(tuple(ring.read(0)), (1, 2, 3, 4))
+            ring.write(2, [9, 9, 9, 9])
+            self.assertIsNone(ring.read(0))
+            self.assertEqual(tuple(ring.read(2)), (9, 9, 9, 9))
+
+
+class TestEmitter(unittest.TestCase):
+    def test_process_emitter(self):
+        data_queue = queue.Queue()
+        emitter = EmitterThread(
+            device=None,
+            data_queue=data_queue,
+            settings=TraceSettings(npoints=16),
+            use_process=True,
+        )
+        emitter.start()
+        try:
+            frame = data_queue.get(timeout=30)
+        finally:
+            emitter.stop()
+        self.assertEqual(len(frame.data), 16)
+        self.assertFalse(emitter.process)
+
+    def test_process_profile(self):
+        profiler = Profiler()
+        profiler.enable(cprofile=True)
+        data_queue = queue.Queue()
+        with unittest.mock.patch("tdr_plots.emitter.profiler", profiler):
+            emitter = EmitterThread(
+                device=None,
+                data_queue=data_queue,
+                settings=TraceSettings(npoints=16),
+                use_process=True,
+                rate=0,
+            )
+            emitter.start()
+            try:
+                data_queue.get(timeout=30)
+            finally:
+                emitter.stop()
+        # The acquisition process profiled itself and sent the stats back
+        self.assertIn("emitter", profiler.stats)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "profile.json")
+            profiler.dump(fname)
+            self.assertTrue(os.path.exists(f"{fname}.emitter.prof"))
+
+    def test_queued_frames_end_with_source(self):
+        frames = iter([Frame(data=np.zeros(4), seq=seq) for seq in range(3)])
+        source = unittest.mock.Mock()
+        source.read_frame.side_effect = lambda: next(frames, None)
+        data_queue = queue.Queue()
+        emitter = EmitterThread(
+            device=None, data_queue=data_queue, settings=TraceSettings(npoints=4), source=source
+        )
+        emitter.start()
+        seqs = [frame.seq for frame in queued_frames(data_queue, emitter.is_alive)]
+        self.assertEqual(seqs, [0, 1, 2])
+
+class TestBroadcast(unittest.TestCase):
+    def test_serve_and_record(self):
+        settings = TraceSettings(npoints=3, naverages=4)
+        server = broadcast.TraceServer(settings, [7, 8, 9], address="tcp://127.0.0.1:0")
+        with server, tempfile.TemporaryDirectory() as tmpdir:
+            client = broadcast.TraceClient(server.address, mode=broadcast.MODE_FULL)
+            self.assertEqual(client.settings.naverages, 4)
+            self.assertEqual(tuple(client.rxdac), (7, 8, 9))
+            wait_for(lambda: server.subscribers)
+            for seq in range(3):
+                score = 0.5 * seq if seq else None
+                server.publish(Frame(data=[seq, seq + 1, seq + 2], seq=seq, score=score))
+
+            fname = os.path.join(tmpdir, "capture.tdr")
+            self.assertEqual(broadcast.record(client, fname, nframes=3), 3)
+            client.close()
+            with broadcast.open_recording(fname) as recording:
+                frames = list(recording)
+            self.assertEqual([f.seq for f in frames], [0, 1, 2])
+            self.assertEqual(tuple(frames[2].data), (2, 3, 4))
+            self.assertEqual([f.score for f in frames], [None, 0.5, 1.0])
+
+    def test_stop_stalled_source(self):
+        settings = TraceSettings(npoints=3)
+        server = broadcast.TraceServer(settings, None, address="tcp://127.0.0.1:0")
+        with server, broadcast.TraceClient(server.address) as client:
+            data_queue = queue.Queue()
+            emitter = EmitterThread(
+                device=None, data_queue=data_queue, settings=settings, source=client
+            )
+            emitter.start()
+            try:
+                wait_for(lambda: server.subscribers)
+                # Nothing is published, the emitter is blocked reading
+                emitter.stop()
+                self.assertFalse(emitter.thread.is_alive())
+
+                # Start reconnects (the server only drops the old connection on a send)
+                emitter.start()
+                wait_for(lambda: len(server.subscribers) == 2)
+                server.publish(Frame(data=[1, 2, 3], seq=7))
+                self.assertEqual(data_queue.get(timeout=5).seq, 7)
+            finally:
+                emitter.stop()
+
+class TestAnalysis(unittest.TestCase):
+    def test_fault_location(self):
+        volts = np.ones((3, 1000))
+        volts[:, 100:] = 1.5
+        volts[0, 300:] = 1.75  # rho = 0.5
+        volts[1, 500:] = 1.25  # rho = -0.5
+        t = np.arange(1000) * 10.0
+        line = analysis.LineModel(z0=50, velocity_factor=0.66)
+
+        profile = analysis.impedance_profile(volts, t, line=line)
+        self.assertEqual(tuple(profile.launch), (100, 100, 100))
+        self.assertAlmostEqual(profile.impedance[0, 400], 150)
+        self.assertAlmostEqual(profile.impedance[1, 600], 50 / 3)
+
+        edges = analysis.detect_edges(profile)
+        distance = analysis.fault_distance(edges, len(volts))
+        self.assertAlmostEqual(distance[0], line.distance(2000))
+        self.assertAlmostEqual(distance[1], line.distance(4000))
+        self.assertTrue(np.isnan(distance[2]))
+
+class TestDeconvolution(unittest.TestCase):
+    @staticmethod
+    def edge(t, t0, rise_time):
+        sigma = rise_time / 2.5631
+        return 0.5 * (1 + erf((t - t0) / (np.sqrt(2) * sigma)))
+
+    def test_sharpen_edge(self):
+        t = np.arange(2500) * 10.0
+        reference = 1 + 0.5 * self.edge(t, 1000, 60)
+        trace = reference + 0.25 * self.edge(t, 1500, 60)
+        # The ramp time axis isn't uniform
+        t_ramp = t + 0.002 * t**1.2
+        reference = np.interp(t_ramp, t, reference)
+        trace = np.interp(t_ramp, t, trace)
+
+        t_out, y = deconvolve(trace, t_ramp, reference, rise_time=20)
+        y = y[0]
+        lo = t_out[np.argmax(y >= 1.05)]
+        hi = t_out[np.argmax(y >= 1.45)]
+        self.assertLess(hi - lo, 30)
+        self.assertAlmostEqual(np.interp(1300, t_out, y), 1.5, places=2)
+        self.assertAlmostEqual(np.interp(2000, t_out, y), 1.75, places=2)
+
+    def test_bad_reference(self):
+        t = np.arange(100) * 10.0
+        with self.assertRaises(ValueError):
+            deconvolve(np.ones(100), t, np.ones(100))
+        with self.assertRaises(ValueError):
+            deconvolve(np.ones(100), t, self.edge(t[:50], 200, 60))
+
+class TestMonitor(unittest.TestCase):
+    def test_limits(self):
+        t = np.arange(100) * 10.0
+        golden = np.stack([np.full(100, 1.0), np.full(100, 2.0)])
+        failures = []
+        reference_monitor = monitor.ReferenceMonitor(
+            golden=golden,
+            t=t,
+            limits=monitor.Limits(max_abs=0.1, window=(0, 500)),
+            on_fail=[failures.append],
+        )
+        volts = np.stack([np.full(100, 2.05), np.full(100, 1.0)])
+        volts[1, 20] = 1.5  # inside the window
+        volts[0, 80] = 3.0  # outside the window
+        result = reference_monitor.check_volts(volts)
+        self.assertEqual(tuple(result.passed), (True, False))
+        self.assertEqual(tuple(result.golden), (1, 0))
+        self.assertAlmostEqual(result.max_abs[1], 0.5)
+
+        # check() takes raw ADC sums and reports failures
+        frame = np.round(volts[1] / reference_monitor.gain)
+        self.assertFalse(reference_monitor.check(frame, seq=3))
+        self.assertEqual(failures[0].seq, 3)
+
+    def test_source_stopped(self):
+        reference_monitor = monitor.ReferenceMonitor(golden=np.ones((1, 4)), t=np.arange(4.0))
+        data_queue = queue.Queue()
+        data_queue.put(Frame(data=np.full(4, 2275), seq=0))
+        # The frame already queued is checked, then the dead source ends the run
+        checked, failed = monitor.run_checks(
+            reference_monitor, data_queue, nframes=10, alive=lambda: False
+        )
+        self.assertEqual((checked, failed), (1, 0))
+
+
+class TestHistory(unittest.TestCase):
+    def test_ring_and_persistence(self):
+        history = FrameHistory(depth=3, npoints=4)
+        persistence = PersistenceMap(npoints=4, ylim=(0, 4), nbins=4)
+        for value in range(5):
+            _, evicted = history.append(np.full(4, value))
+            if evicted is not None:
+                persistence.add(evicted, weight=-1)
+            persistence.add(np.full(4, value))
+        self.assertEqual(tuple(history.ordered()[:, 0]), (2, 3, 4))
+        # 4 is clipped into the top bin along with 3
+        self.assertEqual(tuple(persistence.counts[:, 0]), (0, 0, 1, 2))
+
+        rebuilt = PersistenceMap(npoints=4, ylim=(0, 4), nbins=4)
+        rebuilt.fill(history.ordered())
+        np.testing.assert_array_equal(rebuilt.counts, persistence.counts)
+
+class TestSimulator(unittest.TestCase):
+    def test_take_trace(self):
+        with SimulatedDevice(seed=0) as device:
+            device.write("POINTS 100\n")
+            self.assertEqual(device.query("POINTS?").strip(), "100")
+            self.assertEqual(len(take_trace(device, npoints=100)), 100)
+            self.assertEqual(len(take_trace(device, command="RXDAC?", npoints=100)), 100)
+
+    def test_segment_retake(self):
+        settings = TraceSettings(npoints=2500)
+        with SimulatedDevice(seed=0) as device:
+            reply = device.dev.reply
+            requests = []
+
+            def corrupt_first(command):
+                block = reply(command)
+                if command == "TRACE":
+                    requests.append((device.dev.state["ISTART"], device.dev.state["POINTS"]))
+                    if len(requests) == 1:
+                        values = np.array(block.decode().split(","), dtype=int)
+                        values[700] = 1 << 20
+                        values[1500:1503] += 3000
+                        block = (",".join(map(str, values)) + "\n").encode()
+                return block
+
+            device.dev.reply = corrupt_first
+            data = take_valid_trace(device, settings, FrameCheck())
+            self.assertEqual(requests, [("0", "2500"), ("696", "9"), ("1496", "11")])
+            self.assertEqual(device.dev.state["POINTS"], "2500")
+        self.assertFalse(FrameCheck().bad_points(data, settings.naverages).any())
+
+    def test_repeated_glitch_is_kept(self):
+        # A few mm of 90 ohm line reflects a spike only a few samples wide
+        line = SyntheticLine(
+            segments=[Segment(0.5, 50), Segment(0.004, 90), Segment(1.0, 50)],
+            rise_time=20,
+            dispersion=0,
+            z_load=50,
+        )
+        settings = TraceSettings(npoints=2500)
+        check = FrameCheck()
+        with SimulatedDevice(seed=0, line=line) as device:
+            reply = device.dev.reply
+            requests = []
+
+            def count(command):
+                if command == "TRACE":
+                    requests.append(device.dev.state["ISTART"])
+                return reply(command)
+
+            device.dev.reply = count
+            for _ in range(5):
+                take_valid_trace(device, settings, check)
+        # Only the first frame retakes the spike
+        self.assertEqual(len(requests), 6)
+        self.assertTrue(check.known[606:610].all())
+
+    def test_synthetic_line(self):
+        line = SyntheticLine(segments=[Segment(0.5, 50), Segment(1.0, 75)], noise=0)
+        settings = TraceSettings(npoints=2000)
+        data_queue = queue.Queue()
+        emitter = EmitterThread(
+            device=None, data_queue=data_queue, settings=settings, rate=0, line=line
+        )
+        emitter.start()
+        frames = [data_queue.get(timeout=5) for _ in range(20)]
+        emitter.stop()
+        self.assertEqual([frame.seq for frame in frames], list(range(20)))
+
+        volts = frames[-1].data / settings.naverages * (3.6 / 4096)
+        profile = analysis.impedance_profile(volts, np.arange(2000) * 10.0)
+        edges = analysis.detect_edges(profile)
+        np.testing.assert_allclose(edges.distance, [0.5, 1.5], atol=0.02)
+        self.assertGreater(edges.step[0], 0)
+
+
+class TestSweep(unittest.TestCase):
+    def test_merge_ramps(self):
+        line = SyntheticLine(noise=0)
+        fast = TraceSettings(npoints=2000, spacing=10, ramp=1)
+        slow = TraceSettings(npoints=2000, spacing=100, ramp=2)
+        cache = RxdacCache()
+        with SimulatedDevice(line=line, seed=0) as device:
+            queries = []
+            reply = device.dev.reply
+            device.dev.reply = lambda command: queries.append(command) or reply(command)
+            for _ in range(2):
+                parts = take_sweep(device, [slow, fast], cache=cache)
+            self.assertEqual(queries.count("RXDAC?"), 2)
+            self.assertEqual(device.dev.state["RES"], "100")
+
+            # A cache kept in a file spares the queries of the next run
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fname = os.path.join(tmpdir, "rxdac.json")
+                take_sweep(device, [slow, fast], cache=RxdacCache(fname, instrument="TDR01"))
+                take_sweep(device, [slow, fast], cache=RxdacCache(fname, instrument="TDR01"))
+                self.assertEqual(queries.count("RXDAC?"), 4)
+                take_sweep(device, [fast], cache=RxdacCache(fname, instrument="other"))
+                self.assertEqual(queries.count("RXDAC?"), 5)
+
+        merged = merge_sweep(parts)
+        self.assertTrue(np.all(np.diff(merged.t) > 0))
+        self.assertEqual(np.count_nonzero(merged.part == 1), 2000)
+        self.assertEqual(merged.t[-1], 199900)
+        np.testing.assert_allclose(merged.weights.sum(axis=0), 1)
+        np.testing.assert_allclose(merged.volts[0], line.volts(merged.t), atol=0.01)
+
+
+class TestAveraging(unittest.TestCase):
+    def test_noise_floor(self):
+        settings = TraceSettings(npoints=2000)
+        averaging = AdaptiveAveraging(target=5e-5, max_avg=256)
+        data_queue = queue.Queue()
+        emitter = EmitterThread(
+            device=None,
+            data_queue=data_queue,
+            settings=settings,
+            rate=0,
+            averaging=averaging,
+            seed=0,
+        )
+        emitter.start()
+        frames = [data_queue.get(timeout=10) for _ in range(8)]
+        emitter.stop()
+
+        # One conversion is ~2.6 mV rms, so ~2700 are needed, more than one transfer
+        self.assertEqual(frames[0].naverages, settings.naverages)
+        self.assertLessEqual(emitter.naverages, 256)
+        self.assertGreater(frames[-1].naverages, 2000)
+        volts = [frame.data * (3.6 / 4096) / frame.naverages for frame in frames[-2:]]
+        noise = np.std(volts[1] - volts[0]) / np.sqrt(2)
+        self.assertLess(noise, 1.5 * averaging.target)
+
+    def test_restart_writes_avg(self):
+        settings = TraceSettings(npoints=100)
+        with SimulatedDevice(seed=0) as device:
+            # AVG left behind by a previous acquisition process
+            device.write("POINTS 100\nAVG 64\n")
+            emitter = EmitterThread(device=device, data_queue=None, settings=settings)
+            emitter.device_naverages = None
+            emitter.take_frame(emitter.naverages)
+            self.assertEqual(device.dev.state["AVG"], "2")
+
+
+class TestGating(unittest.TestCase):
+    def test_change_gate(self):
+        rng = np.random.default_rng(0)
+        line = SyntheticLine()
+        gate = ChangeGate(threshold=6, heartbeat=10, naverages=2)
+
+        def offer(now, line=line):
+            frame = Frame(data=line.counts(2500, 2, rng), naverages=2)
+            return gate.offer(frame, now=now), frame.score
+
+        self.assertEqual(offer(0), (True, np.inf))
+        passed = [offer(0.01 * i)[0] for i in range(1, 500)]
+        self.assertLessEqual(sum(passed), 1)
+
+        line = SyntheticLine(segments=[Segment(0.5, 50), Segment(1.0, 77), Segment(0.5, 50)])
+        changed, score = offer(5.0, line)
+        self.assertTrue(changed)
+        self.assertGreater(score, 6)
+        # Unchanged again, until the heartbeat is due
+        self.assertFalse(offer(10.0, line)[0])
+        self.assertTrue(offer(15.0, line)[0])
+
+
+class TestBatch(unittest.TestCase):
+    def test_analyze_files(self):
+        rng = np.random.default_rng(0)
+        line = SyntheticLine()
+        t = np.arange(2500) * 10.0
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for i in range(4):
+                traces = [line.counts(2500, 2, rng) * (3.6 / 4096 / 2) for _ in range(3)]
+                save_csv(os.path.join(tmpdir, f"capture_{i}.csv"), np.arange(2500), t, traces)
+            with open(os.path.join(tmpdir, "notes.txt"), "w") as f:
+                f.write("not a capture")
+            fnames = batch.discover([tmpdir])
+            self.assertEqual(len(fnames), 4)
+
+            serial = batch.analyze_files(fnames, jobs=1)
+            parallel = batch.analyze_files(fnames, jobs=2, chunksize=1)
+        pd.testing.assert_frame_equal(serial, parallel)
+        self.assertEqual(len(serial), 12)
+        # The open end 2 m down the line is the largest step
+        np.testing.assert_allclose(serial["fault_m"], 2.0, atol=0.02)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_render_and_serve(self):
+        settings = TraceSettings(npoints=500, naverages=2)
+        renderer = SnapshotRenderer(settings, size=(4, 3), dpi=50)
+        self.assertIsNone(renderer.snapshot("png"))
+        rng = np.random.default_rng(0)
+        renderer.update(Frame(data=SyntheticLine().counts(500, 2, rng), seq=1))
+        png = renderer.snapshot("png")
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        # Cached until the next frame
+        self.assertIs(renderer.snapshot("png"), png)
+        self.assertIn(b"<svg", renderer.snapshot("svg"))
+
+        with SnapshotServer(renderer, ("127.0.0.1", 0)) as server:
+            url = "http://%s:%d/latest.png" % server.address[:2]
+            with urllib.request.urlopen(url) as reply:
+                self.assertEqual(reply.headers["X-Frame-Seq"], "1")
+                self.assertEqual(reply.read(), png)
+
+
+class TestLibrary(unittest.TestCase):
+    def test_persist_and_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with TraceLibrary(tmpdir, capacity=3, max_points=100) as library:
+                for i in range(3):
+                    library.store(np.full(50 + i, float(i)), settings=TraceSettings())
+                library.trace(library.find("Stored Trace 0"))
+                # Trace 1 is the least recently used
+                library.store(np.full(10, 3.0))
+                library.select(library.find("Stored Trace 2"), False)
+            with TraceLibrary(tmpdir) as library:
+                self.assertEqual(library.capacity, 3)
+                names = [entry.name for entry in library.selected()]
+                self.assertEqual(names, ["Stored Trace 0", "Stored Trace 3"])
+                np.testing.assert_array_equal(library.trace(library.find("Stored Trace 2")), 2.0)
+                self.assertEqual(library.find("Stored Trace 0").settings["npoints"], 2500)
+                # A longer trace widens the rows, keeping the stored ones
+                library.store(np.full(150, 4.0))
+                self.assertEqual(library.max_points, 150)
+            with TraceLibrary(tmpdir) as library:
+                self.assertEqual(library.traces.shape, (3, 150))
+                np.testing.assert_array_equal(library.trace(library.find("Stored Trace 2")), 2.0)
+                np.testing.assert_array_equal(library.trace(library.find("Stored Trace 4")), 4.0)
+
+    def test_resize_and_lock(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with TraceLibrary(tmpdir, capacity=4, max_points=10) as library:
+                for i in range(4):
+                    library.store(np.full(10, float(i)))
+                library.trace(library.find("Stored Trace 0"))
+                # A second writer is refused until the first closes
+                with self.assertRaises(LibraryLockedError):
+                    TraceLibrary(tmpdir)
+            # Shrinking keeps the most recently used entries
+            with TraceLibrary(tmpdir, capacity=2) as library:
+                self.assertEqual(
+                    [entry.name for entry in library.ordered()], ["Stored Trace 0", "Stored Trace 3"]
+                )
+            with TraceLibrary(tmpdir, capacity=8) as library:
+                self.assertEqual(library.traces.shape, (8, 10))
+                np.testing.assert_array_equal(library.trace(library.find("Stored Trace 3")), 3.0)
+                library.store(np.full(10, 4.0))
+                self.assertEqual(len(library), 3)
+
+    def test_scope_stored_traces(self):
+        settings = TraceSettings(npoints=2000, spacing=10)
+        library = TraceLibrary(capacity=4, max_points=100)
+        library.store(np.full(500, 2.0), settings=TraceSettings(npoints=500, spacing=100))
+        library.store(np.full(50, 3.0), settings=TraceSettings(npoints=50, spacing=10))
+        scope = Scope(Figure().add_subplot(), dt=10, settings=settings, library=library)
+        # Each stored trace is drawn on its own time axis
+        ends = sorted(line.get_xdata()[-1] for line in scope.stored_lines.values())
+        self.assertEqual(ends, [490, 49900])
+
+        scope.line.set_data(np.arange(2000) * 10.0, np.ones(2000))
+        scope.rxdac = np.arange(2000)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "scope.csv")
+            with unittest.mock.patch("tdr_plots.live_plot.get_filename", return_value=fname):
+                scope.save_csv()
+            df = pd.read_csv(fname)
+        # The live trace at full length, the 100 ps trace left out
+        self.assertEqual(len(df), 2000)
+        self.assertEqual(list(df.columns[2:]), ["Trace_0", "Trace_1"])
+        self.assertEqual(df["Trace_1"].count(), 50)
+
+    def test_decimate(self):
+        y = np.zeros(10000)
+        y[1234] = 1
+        y[5678] = -1
+        x, decimated = minmax_decimate(np.arange(10000), y, nbuckets=100)
+        self.assertEqual(len(decimated), 200)
+        self.assertEqual((decimated.max(), decimated.min()), (1, -1))
+        self.assertTrue(np.all(np.diff(x) >= 0))
+
+
+class TestProfiler(unittest.TestCase):
+    def test_spans(self):
+        profiler = Profiler(window=10)
+        with profiler.span("parse"):
+            pass
+        self.assertEqual(profiler.summary(), {})
+
+        profiler.enable()
+        for seconds in (0.001, 0.002, 0.003):
+            profiler.record("canvas draw", seconds)
+        with profiler.span("parse"):
+            pass
+        summary = profiler.summary()
+        self.assertEqual(list(summary), ["parse", "canvas draw"])
+        self.assertEqual(summary["canvas draw"]["count"], 3)
+        self.assertAlmostEqual(summary["canvas draw"]["mean_ms"], 2)
+
+    def test_gui_defers_to_emitter(self):
+        profiler = Profiler()
+        profiler.enable(cprofile=True)
+        with unittest.mock.patch("tdr_plots.profiling._ONE_CPROFILE", True):
+            with profiler.thread_profile("gui", defer_to="emitter"):
+                with profiler.thread_profile("emitter"):
+                    pass
+        self.assertEqual(list(profiler.profiles), ["emitter"])
+
+    def test_device_spans(self):
+        profiler = Profiler()
+        profiler.enable()
+        with SimulatedDevice(seed=0) as device:
+            device.span = profiler.span
+            take_trace(device)
+        self.assertEqual(list(profiler.summary()), ["command write", "serial wait", "parse"])
+
 
 if __name__ == "__main__":
     unittest.main()